@@ -1,46 +1,90 @@
 import collections
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 from math import ceil
 from urllib.parse import urlencode
 
 from django import forms
+from django.conf import settings
 from django.contrib import messages
 from django.utils.functional import cached_property
 from django.utils.dateformat import format as format_date
 from django.utils.safestring import mark_safe
 from django.utils.translation import gettext, gettext_lazy, ngettext
-from mtp_common.api import retrieve_all_pages_for_path
 from mtp_common.auth.api_client import get_api_session
 
-from .tasks import credit_selected_credits_to_nomis
+from .tasks import credit_selected_credits_to_nomis, pack_credits
 from .templatetags.credits import parse_date_fields
+from .utils import (
+    PendingCredit, PendingCredits,
+    get_credit_ids_digest, get_user_prison_ids, invalidate_credit_sets, load_credit_snapshot,
+    retrieve_all_pages_by_prison, retrieve_all_pages_concurrently, retrieve_credit_set, start_crediting_progress,
+)
 
 MANUALLY_CREDITED_LOG_LEVEL = 21
 
 
-class ProcessNewCreditsForm(forms.Form):
-    credits = forms.MultipleChoiceField(choices=(), required=False)
+class CreditsChoiceField(forms.MultipleChoiceField):
+    """
+    Multiple choice of credits where each submitted id is checked against a set of choices
+    rather than by scanning them all
+    """
+
+    def valid_value(self, value):
+        if not hasattr(self, 'valid_values'):
+            self.valid_values = {str(choice) for choice, _ in self.choices}
+        return str(value) in self.valid_values
 
-    def __init__(self, request, ordering='-received_at', *args, **kwargs):
+
+class ProcessNewCreditsForm(forms.Form):
+    credits = CreditsChoiceField(choices=(), required=False)
+    # holds `credit_ids_digest` when all credits are selected, including those not yet loaded into the page,
+    # in which case only the comma-separated ids of credits excluded from the selection are submitted
+    select_all = forms.CharField(required=False, widget=forms.HiddenInput)
+    excluded = forms.CharField(required=False, widget=forms.HiddenInput)
+    # references the credits rendered to the user, see `save_credit_snapshot`
+    snapshot = forms.CharField(required=False, widget=forms.HiddenInput)
+
+    def __init__(self, request, ordering='-received_at', pending_credits=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.request = request
         self.user = request.user
         self.session = get_api_session(request)
         self.ordering = ordering
+        self.pending_credits = pending_credits or PendingCredits(self.session, self.user, ordering)
 
-        self.fields['credits'].choices = [(id, f'Credit {id}') for id, _ in self.credit_choices]
+        # choices are only loaded when the form is validated
+        self.fields['credits'].choices = self.get_credit_field_choices
+
+    def get_credit_field_choices(self):
+        return [(credit_id, f'Credit {credit_id}') for credit_id in self.credit_index]
 
     def _request_all_credits(self):
-        return retrieve_all_pages_for_path(
-            self.session, 'credits/', status='credit_pending', resolution='pending',
-            ordering=self.ordering
-        )
+        return self.pending_credits.get_credits('pending')
+
+    def clean_excluded(self):
+        excluded = self.cleaned_data.get('excluded') or ''
+        try:
+            return {int(credit_id) for credit_id in excluded.split(',') if credit_id}
+        except ValueError:
+            raise forms.ValidationError(gettext_lazy('Select a valid choice'), code='invalid')
 
-    def clean_credits(self):
-        credits = self.cleaned_data.get('credits', [])
-        if not credits:
+    def clean(self):
+        cleaned_data = super().clean()
+        select_all = cleaned_data.get('select_all')
+        if select_all:
+            if select_all != self.credit_ids_digest:
+                self.add_error(None, gettext('The list of new credits has changed, please check them and select again'))
+                return cleaned_data
+            excluded = cleaned_data.get('excluded') or set()
+            cleaned_data['credits'] = [
+                str(credit_id)
+                for credit_id in self.credit_index
+                if credit_id not in excluded
+            ]
+        if not cleaned_data.get('credits'):
             self.add_error(None, gettext('Only click ‘Credit to NOMIS’ when you’ve selected credits'))
-        return credits
+        return cleaned_data
 
     @cached_property
     def credit_choices(self):
@@ -49,49 +93,182 @@ class ProcessNewCreditsForm(forms.Form):
         """
         credits = self._request_all_credits()
         return [
-            (t['id'], t) for t in parse_date_fields(credits)
+            (credit['id'], PendingCredit(**credit)) for credit in credits
         ]
 
-    def save(self):
-        credit_ids = [int(c_id) for c_id in set(self.cleaned_data['credits'])]
-        credits = dict(self.credit_choices)
+    @cached_property
+    def credit_index(self):
+        """
+        Credits available to select keyed by id; a submitted form uses the snapshot
+        of credits rendered to the user if it is still available
+        """
+        if self.is_bound:
+            snapshot = load_credit_snapshot(self.user, self.data.get(self.add_prefix('snapshot')))
+            if snapshot is not None:
+                credit_index = self.complete_snapshot(snapshot)
+                if credit_index is not None:
+                    return credit_index
+        return dict(self.credit_choices)
+
+    def complete_snapshot(self, snapshot):
+        """
+        Adds selected credits that were merged into the page after the snapshot was taken
+        :return: dict of PendingCredit keyed by id or None if the snapshot cannot be used
+        """
+        select_all = self.data.get(self.add_prefix('select_all'))
+        if select_all and select_all != get_credit_ids_digest(snapshot):
+            # all credits were selected after changes were merged into the page
+            return None
+
+        missing_credit_ids = set()
+        for credit_id in self.data.getlist(self.add_prefix('credits')):
+            try:
+                credit_id = int(credit_id)
+            except ValueError:
+                continue
+            if credit_id not in snapshot:
+                missing_credit_ids.add(credit_id)
+        if not missing_credit_ids:
+            return snapshot
+
+        credit_index = dict(snapshot)
+        credit_index.update(self.get_pending_credits(sorted(missing_credit_ids)))
+        return credit_index
+
+    @cached_property
+    def credit_ids_digest(self):
+        return get_credit_ids_digest(self.credit_index)
+
+    def get_pending_credits(self, credit_ids):
+        """
+        Loads the current state of selected credits just before crediting them
+        because the credits rendered to the user may since have been credited by someone else
+        or their prisoners may have moved; ids are queried REQUEST_PAGE_SIZE at a time
+        :return: dict of selected credits that are still pending keyed by id
+        """
+        chunk_size = settings.REQUEST_PAGE_SIZE
+        chunks = [credit_ids[start:start + chunk_size] for start in range(0, len(credit_ids), chunk_size)]
 
+        def retrieve_chunk(chunk_credit_ids):
+            return retrieve_all_pages_concurrently(
+                self.session, 'credits/', status='credit_pending', resolution='pending', pk=chunk_credit_ids,
+            )
+
+        with ThreadPoolExecutor(
+            max_workers=min(settings.API_CONCURRENT_PAGE_REQUESTS, len(chunks)),
+            thread_name_prefix='api-pages',
+        ) as executor:
+            return {
+                credit['id']: PendingCredit(**credit)
+                for credits in executor.map(retrieve_chunk, chunks)
+                for credit in credits
+            }
+
+    def save(self):
+        credit_ids = sorted(int(c_id) for c_id in set(self.cleaned_data['credits']))
+
+        credits = self.get_pending_credits(credit_ids)
+        invalidate_credit_sets(self.user)
+        resolved_credit_count = len(credit_ids) - len(credits)
+        if resolved_credit_count:
+            messages.warning(self.request, ngettext(
+                '%(count)d credit was skipped because someone else has already processed it',
+                '%(count)d credits were skipped because someone else has already processed them',
+                resolved_credit_count,
+            ) % {'count': resolved_credit_count})
+            credit_ids = [credit_id for credit_id in credit_ids if credit_id in credits]
+            if not credit_ids:
+                return
+
+        # one batch tracks progress of the whole selection
         self.session.post('credits/batches/', json={'credits': credit_ids})
-        credit_selected_credits_to_nomis(
-            user=self.request.user, user_session=self.request.session,
-            selected_credit_ids=credit_ids, credits=credits
-        )
+        # but it is credited in chunks, each spooled separately
+        chunk_size = settings.CREDITING_BATCH_CHUNK_SIZE
+        chunk_starts = range(0, len(credit_ids), chunk_size)
+        progress_keys = start_crediting_progress(self.user, credit_ids, len(chunk_starts))
+        for start, progress_key in zip(chunk_starts, progress_keys):
+            chunk_credit_ids = credit_ids[start:start + chunk_size]
+            credit_selected_credits_to_nomis(
+                user=self.request.user, user_session=self.request.session,
+                selected_credit_ids=chunk_credit_ids,
+                credits=pack_credits({credit_id: credits[credit_id] for credit_id in chunk_credit_ids}),
+                progress_key=progress_key,
+            )
 
 
 class ProcessManualCreditsForm(forms.Form):
+    """
+    Marks credits that needed manual input as credited, either individually with a `submit_manual_<id>` button
+    or in bulk with the `submit_manual_selected` button
+    """
     credit = forms.ChoiceField(choices=(), required=False)
+    selected_credits = CreditsChoiceField(choices=(), required=False)
 
-    def __init__(self, request, ordering='-received_at', *args, **kwargs):
+    submit_prefix = 'submit_manual_'
+    submit_selected = 'submit_manual_selected'
+
+    def __init__(self, request, ordering='-received_at', pending_credits=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.request = request
         self.user = request.user
         self.session = get_api_session(request)
         self.ordering = ordering
+        self.pending_credits = pending_credits or PendingCredits(self.session, self.user, ordering)
+
+        # choices are only loaded when the form is validated
+        self.fields['credit'].choices = self.get_credit_field_choices
+        self.fields['selected_credits'].choices = self.get_credit_field_choices
 
-        self.fields['credit'].choices = [(id, f'Credit {id}') for id, _ in self.credit_choices]
+    def get_credit_field_choices(self):
+        return [(credit_id, f'Credit {credit_id}') for credit_id in self.credit_index]
 
     def _request_all_credits(self):
-        return retrieve_all_pages_for_path(
-            self.session, 'credits/', status='credit_pending', resolution='manual',
-            ordering=self.ordering
-        )
+        return self.pending_credits.get_credits('manual')
+
+    @cached_property
+    def submitted_credit_ids(self):
+        if not self.is_bound:
+            return []
+        if self.submit_selected in self.data:
+            credit_ids = self.data.getlist(self.add_prefix('selected_credits'))
+        else:
+            credit_ids = [
+                key[len(self.submit_prefix):]
+                for key in self.data
+                if key.startswith(self.submit_prefix)
+            ][:1]
+        submitted_credit_ids = []
+        for credit_id in credit_ids:
+            try:
+                submitted_credit_ids.append(int(credit_id))
+            except ValueError:
+                continue
+        return submitted_credit_ids
 
     def clean_credit(self):
-        prefix = 'submit_manual_'
-        if self.request.method == 'POST':
-            for key in self.request.POST:
-                if key.startswith(prefix):
-                    credit_id = int(key[len(prefix):])
-                    if not self.credit_choices or credit_id not in next(zip(*self.credit_choices)):
-                        raise forms.ValidationError(
-                            gettext_lazy('That credit cannot be manually credited'), code='invalid'
-                        )
-                    return credit_id
+        if self.is_bound and self.submit_selected not in self.data:
+            for credit_id in self.submitted_credit_ids:
+                if credit_id not in self.credit_index:
+                    raise forms.ValidationError(
+                        gettext_lazy('That credit cannot be manually credited'), code='invalid'
+                    )
+                return credit_id
+
+    def clean_selected_credits(self):
+        return [int(credit_id) for credit_id in self.cleaned_data.get('selected_credits') or []]
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if self.is_bound and self.submit_selected in self.data:
+            cleaned_data['credit_ids'] = cleaned_data.get('selected_credits') or []
+            if not cleaned_data['credit_ids'] and 'selected_credits' not in self.errors:
+                self.add_error(None, gettext('Only click ‘Done’ when you’ve selected credits'))
+        else:
+            credit_id = cleaned_data.get('credit')
+            cleaned_data['credit_ids'] = [int(credit_id)] if credit_id else []
+            if not cleaned_data['credit_ids'] and 'credit' not in self.errors:
+                self.add_error(None, gettext('That credit cannot be manually credited'))
+        return cleaned_data
 
     @cached_property
     def credit_choices(self):
@@ -100,24 +277,52 @@ class ProcessManualCreditsForm(forms.Form):
         """
         credits = self._request_all_credits()
         return [
-            (t['id'], t) for t in parse_date_fields(credits)
+            (credit['id'], PendingCredit(**credit)) for credit in credits
         ]
 
-    def save(self):
-        credit_id = int(self.cleaned_data['credit'])
-        self.session.post(
-            'credits/actions/credit/',
-            json=[{'id': credit_id, 'credited': True}]
-        )
-        manually_credited = 1
+    @cached_property
+    def credit_index(self):
+        """
+        Credits available to mark as credited keyed by id;
+        a submitted form only loads the credits it refers to
+        """
+        if self.is_bound:
+            if not self.submitted_credit_ids:
+                return {}
+            credits = retrieve_all_pages_concurrently(
+                self.session, 'credits/',
+                status='credit_pending', resolution='manual', pk=sorted(set(self.submitted_credit_ids)),
+            )
+            return {credit['id']: PendingCredit(**credit) for credit in credits}
+        return dict(self.credit_choices)
+
+    @property
+    def manually_credited(self):
+        """
+        Running count of credits manually input by the user, carried between submissions in the query string
+        """
+        manually_credited = len(self.cleaned_data['credit_ids'])
         try:
             manually_credited += int(self.request.GET.get('manually_credited'))
         except (ValueError, TypeError):
             pass
+        return manually_credited
+
+    def mark_credited(self):
+        credit_ids = self.cleaned_data['credit_ids']
+        self.session.post(
+            'credits/actions/credit/',
+            json=[{'id': credit_id, 'credited': True} for credit_id in credit_ids]
+        )
+        invalidate_credit_sets(self.user)
+        return credit_ids
+
+    def save(self):
+        credit_ids = self.mark_credited()
         messages.add_message(
-            self.request, MANUALLY_CREDITED_LOG_LEVEL, str(manually_credited)
+            self.request, MANUALLY_CREDITED_LOG_LEVEL, str(self.manually_credited)
         )
-        return credit_id
+        return credit_ids
 
 
 class FilterProcessedCreditsListForm(forms.Form):
@@ -255,8 +460,10 @@ class FilterProcessedCreditsDetailForm(FilterProcessedCreditsListForm):
         return self.cleaned_data['ordering'] or self.fields['ordering'].initial
 
     def retrieve_credits(self, offset, limit, **filters):
-        credits = retrieve_all_pages_for_path(
-            self.session, 'credits/', **dict(self.default_filters, **filters)
+        filters = dict(self.default_filters, **filters)
+        # credits already processed do not change so one set serves every page load until the user credits more
+        credits = retrieve_credit_set(
+            self.session, self.user, 'credits/', filters.pop('ordering', None), 'processed-credits', **filters
         )
         return len(credits), credits
 
@@ -359,8 +566,8 @@ class SearchForm(forms.Form):
         }
         results = response.get('results', [])
         if page == 1:
-            new_credits = retrieve_all_pages_for_path(
-                self.session, 'credits/', status='credit_pending', **filters
+            new_credits = retrieve_all_pages_by_prison(
+                self.session, 'credits/', get_user_prison_ids(self.user), status='credit_pending', **filters
             )
             self.pagination['full_count'] += len(new_credits)
             results = new_credits + results
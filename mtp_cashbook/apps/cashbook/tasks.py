@@ -1,49 +1,455 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, zip_longest
+import json
 import logging
-from threading import local
+import os
+from threading import BoundedSemaphore, Lock, local
+import time
 from urllib.parse import urljoin
 
 from django.conf import settings
+from django.core.cache import caches
 from django.utils.dateformat import format as format_date
 from mtp_common import nomis
 from mtp_common.auth.api_client import get_api_session_with_session
-from mtp_common.spooling import spoolable
-from mtp_common.tasks import send_email
+from mtp_common.notify import NotifyClient
+from mtp_common.spooling import Context, spoolable
 from mtp_common.utils import format_currency
+from notifications_python_client.errors import APIError, InvalidResponse
 import requests
 from requests.exceptions import HTTPError, RequestException
 
+from mtp_cashbook.utils import invalidate_prisoner_location
+from .utils import PendingCredit, get_credit_ids_digest, publish_crediting_progress
+
 logger = logging.getLogger('mtp')
 
 thread_local = local()
 thread_local.nomis_session = requests.Session()
 
 
+class NomisCircuitBreaker:
+    """
+    Stops crediting tasks from calling NOMIS once NOMIS_CIRCUIT_BREAKER_FAILURE_THRESHOLD consecutive calls
+    have failed with server or connection errors so that an outage does not hold up spooler workers.
+    The circuit is shared by all spooler processes; after NOMIS_CIRCUIT_BREAKER_RESET_TIMEOUT seconds
+    one trial call is let through which closes the circuit if it succeeds or opens it again if not.
+    """
+    failures_key = 'nomis-circuit-failures'
+    opened_key = 'nomis-circuit-opened'
+    trial_key = 'nomis-circuit-trial'
+
+    @property
+    def cache(self):
+        return caches['nomis_circuit']
+
+    def allow_request(self):
+        opened = self.cache.get(self.opened_key)
+        if opened is None:
+            return True
+        if time.time() - opened < settings.NOMIS_CIRCUIT_BREAKER_RESET_TIMEOUT:
+            return False
+        # half-open: only one trial call at a time
+        return self.cache.add(self.trial_key, True, timeout=settings.NOMIS_CIRCUIT_BREAKER_RESET_TIMEOUT)
+
+    def record_success(self):
+        if self.cache.get(self.failures_key) is None:
+            return
+        self.cache.delete_many([self.failures_key, self.opened_key, self.trial_key])
+        logger.info('NOMIS circuit closed')
+
+    def record_failure(self):
+        try:
+            failures = self.cache.incr(self.failures_key)
+        except ValueError:
+            # first failure or the count was reset by a success in another thread or spooler in the meantime
+            failures = 1
+            self.cache.set(self.failures_key, failures)
+        if failures >= settings.NOMIS_CIRCUIT_BREAKER_FAILURE_THRESHOLD:
+            if self.cache.get(self.opened_key) is None:
+                logger.error('NOMIS circuit opened after %(failures)d failures', {'failures': failures})
+            self.cache.set(self.opened_key, time.time())
+            self.cache.delete(self.trial_key)
+
+
+nomis_circuit_breaker = NomisCircuitBreaker()
+
+
+class CreditingCheckpoint:
+    """
+    Durably records the outcome of sending each credit to NOMIS and whether it was written to the API
+    in CREDITING_CHECKPOINT_DIR so that a crediting task interrupted part-way through, and run again
+    by the uWSGI spooler, does not call NOMIS again for credits already transacted.
+    Removed once the task completes unless some outcomes could not be written to the API,
+    in which case it is removed when a later checkpoint is opened after CREDITING_CHECKPOINT_MAX_AGE seconds.
+    """
+
+    def __init__(self, credit_ids):
+        self.path = os.path.join(
+            settings.CREDITING_CHECKPOINT_DIR,
+            f'crediting-{get_credit_ids_digest(credit_ids)}.jsonl',
+        )
+        self.lock = Lock()
+        self.file = None
+        # outcome and NOMIS transaction id of credits sent to NOMIS, keyed by credit id
+        self.transacted = {}
+        self.written = set()
+        self.remove_expired()
+        self.load()
+
+    @classmethod
+    def remove_expired(cls):
+        expires = time.time() - settings.CREDITING_CHECKPOINT_MAX_AGE
+        try:
+            entries = list(os.scandir(settings.CREDITING_CHECKPOINT_DIR))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if not (entry.name.startswith('crediting-') and entry.name.endswith('.jsonl')):
+                continue
+            try:
+                if entry.stat().st_mtime < expires:
+                    os.remove(entry.path)
+                    logger.warning('Removed expired crediting checkpoint %(name)s', {'name': entry.name})
+            except FileNotFoundError:
+                # removed by another crediting task
+                pass
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line was not fully written
+                        break
+                    if 'written' in entry:
+                        self.written.update(entry['written'])
+                    else:
+                        self.transacted[entry['id']] = (entry['outcome'], entry.get('nomis_transaction_id'))
+        except FileNotFoundError:
+            return
+        logger.info('Resuming crediting from checkpoint with %(count)d credits sent to NOMIS', {
+            'count': len(self.transacted),
+        })
+
+    def record(self, entry):
+        with self.lock:
+            if self.file is None:
+                os.makedirs(settings.CREDITING_CHECKPOINT_DIR, exist_ok=True)
+                self.file = open(self.path, 'a')
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def record_transacted(self, credit_id, outcome, nomis_transaction_id=None):
+        if self.transacted.get(credit_id) == (outcome, nomis_transaction_id):
+            return
+        self.transacted[credit_id] = (outcome, nomis_transaction_id)
+        entry = {'id': credit_id, 'outcome': outcome}
+        if nomis_transaction_id:
+            entry['nomis_transaction_id'] = nomis_transaction_id
+        self.record(entry)
+
+    def record_written(self, credit_ids):
+        self.written.update(credit_ids)
+        self.record({'written': list(credit_ids)})
+
+    @property
+    def unwritten_ids(self):
+        return set(self.transacted) - self.written
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class CreditUpdates:
+    """
+    Collects the outcomes of sending credits to NOMIS from crediting workers and writes them to the API in bulk
+    once CREDIT_UPDATES_BATCH_SIZE have accumulated, CREDIT_UPDATES_INTERVAL seconds have passed since the last write
+    or when closed. Senders of credited credits are notified in one spooled task once the API has been updated.
+    If given a `progress_key`, counts of credits written to the API are published after each write,
+    see `cashbook.utils.get_crediting_progress`, and if given a `checkpoint`, outcomes are recorded in it.
+    """
+
+    def __init__(self, user, user_session, progress_key=None, checkpoint=None):
+        self.user = user
+        self.user_session = user_session
+        self.progress_key = progress_key
+        self.checkpoint = checkpoint
+        self.api_session = None
+        self.credited = []
+        self.set_manual = []
+        # (prison, prisoner_number) pairs whose NOMIS balance has changed
+        self.credited_prisoners = set()
+        self.progress = {'done': 0, 'failed': 0, 'manual': 0}
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.last_flushed = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def add_credited(self, credit_id, credit, nomis_transaction_id=None):
+        if self.checkpoint:
+            self.checkpoint.record_transacted(credit_id, 'credited', nomis_transaction_id)
+        with self.lock:
+            self.credited.append((credit_id, credit, nomis_transaction_id))
+            self.credited_prisoners.add((credit['prison'], credit['prisoner_number']))
+        self.flush_if_due()
+
+    def add_set_manual(self, credit_id):
+        if self.checkpoint:
+            self.checkpoint.record_transacted(credit_id, 'manual')
+        with self.lock:
+            self.set_manual.append(credit_id)
+        self.flush_if_due()
+
+    def add_written(self, credit, outcome):
+        # credit was already written to the API before crediting was interrupted
+        with self.lock:
+            if outcome == 'credited':
+                self.progress['done'] += 1
+                self.credited_prisoners.add((credit['prison'], credit['prisoner_number']))
+            else:
+                self.progress['manual'] += 1
+
+    def add_failed(self, credit_id):
+        with self.lock:
+            self.progress['failed'] += 1
+
+    def flush_if_due(self):
+        with self.lock:
+            due = (
+                len(self.credited) + len(self.set_manual) >= settings.CREDIT_UPDATES_BATCH_SIZE
+                or time.monotonic() - self.last_flushed >= settings.CREDIT_UPDATES_INTERVAL
+            )
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                credited, self.credited = self.credited, []
+                set_manual, self.set_manual = self.set_manual, []
+                self.last_flushed = time.monotonic()
+            if credited or set_manual:
+                if self.api_session is None:
+                    self.api_session = get_api_session_with_session(self.user, self.user_session)
+                if set_manual:
+                    self.write_set_manual(set_manual)
+                if credited:
+                    self.write_credited(credited)
+            if self.progress_key:
+                with self.lock:
+                    progress = dict(self.progress)
+                publish_crediting_progress(self.progress_key, **progress)
+
+    def write_updates(self, path, updates, make_payload):
+        """
+        Writes updates for several credits to the API in one request, retrying once unless the API rejects it,
+        and then falls back to writing them one at a time so that one rejected credit does not hold up the rest
+        :param path: URL path of the API action
+        :param updates: list of updates, each for a single credit
+        :param make_payload: makes the request body for a list of updates
+        :return: updates that were written
+        """
+        for _ in range(2):
+            try:
+                self.api_session.post(path, json=make_payload(updates))
+                return updates
+            except HTTPError as e:
+                if e.response is not None and 400 <= e.response.status_code < 500:
+                    break
+            except RequestException:
+                pass
+        if len(updates) == 1:
+            return []
+        written = []
+        for update in updates:
+            try:
+                self.api_session.post(path, json=make_payload([update]))
+            except RequestException:
+                continue
+            written.append(update)
+        return written
+
+    def write_set_manual(self, set_manual):
+        written = self.write_updates(
+            'credits/actions/setmanual/', set_manual,
+            lambda credit_ids: {'credit_ids': [int(credit_id) for credit_id in credit_ids]},
+        )
+        failed = [credit_id for credit_id in set_manual if credit_id not in written]
+        if failed:
+            logger.error('Credits %(credit_ids)s could not be set as needing manual input', {
+                'credit_ids': ', '.join(map(str, failed)),
+            })
+        if written and self.checkpoint:
+            self.checkpoint.record_written(written)
+        with self.lock:
+            self.progress['manual'] += len(written)
+            self.progress['failed'] += len(failed)
+
+    def write_credited(self, credited):
+        def make_payload(updates):
+            credit_updates = []
+            for credit_id, _, nomis_transaction_id in updates:
+                credit_update = {'id': credit_id, 'credited': True}
+                if nomis_transaction_id:
+                    credit_update['nomis_transaction_id'] = nomis_transaction_id
+                credit_updates.append(credit_update)
+            return credit_updates
+
+        written = self.write_updates('credits/actions/credit/', credited, make_payload)
+        written_ids = [credit_id for credit_id, _, _ in written]
+        failed_ids = [credit_id for credit_id, _, _ in credited if credit_id not in written_ids]
+        if failed_ids:
+            logger.error('Credits %(credit_ids)s could not be marked as credited', {
+                'credit_ids': ', '.join(map(str, failed_ids)),
+            })
+        if written and self.checkpoint:
+            self.checkpoint.record_written(written_ids)
+        with self.lock:
+            self.progress['done'] += len(written)
+            self.progress['failed'] += len(failed_ids)
+
+        confirmations = {
+            credit_id: credit
+            for credit_id, credit, _ in written
+            if credit.get('sender_email')
+        }
+        if confirmations:
+            send_credited_confirmations(credits=confirmations)
+
+
+# fields of credits needed to send them to NOMIS and to notify their senders
+CREDITING_FIELDS = (
+    'prison', 'prisoner_number', 'amount', 'sender_name',
+    'sender_email', 'short_payment_ref', 'intended_recipient', 'received_at',
+)
+
+
+def pack_credits(credits):
+    """
+    Packs credits to be spooled for crediting into tuples of their id and CREDITING_FIELDS
+    so that spool files do not carry every field loaded from the API
+    :param credits: dict of credits keyed by id
+    """
+    return [
+        (credit_id, *(credit[field] for field in CREDITING_FIELDS))
+        for credit_id, credit in credits.items()
+    ]
+
+
+def unpack_credits(packed_credits):
+    return {
+        credit_id: PendingCredit(id=credit_id, **dict(zip(CREDITING_FIELDS, values)))
+        for credit_id, *values in packed_credits
+    }
+
+
 @spoolable(body_params=('user', 'user_session', 'selected_credit_ids', 'credits',))
-def credit_selected_credits_to_nomis(*, user, user_session, selected_credit_ids, credits):
-    credited = 0
+def credit_selected_credits_to_nomis(*, user, user_session, selected_credit_ids, credits, progress_key=None):
+    if not isinstance(credits, dict):
+        credits = unpack_credits(credits)
+    checkpoint = CreditingCheckpoint(selected_credit_ids)
+    credit_updates = CreditUpdates(user, user_session, progress_key=progress_key, checkpoint=checkpoint)
+    credit_ids_by_prison = {}
     for credit_id in selected_credit_ids:
-        if credit_id in credits:
-            credit_individual_credit_to_nomis(user, user_session, credit_id, credits[credit_id])
-            credited += 1
+        if credit_id in checkpoint.transacted and credit_id in credits:
+            # resuming an interrupted task: NOMIS is not called again
+            outcome, nomis_transaction_id = checkpoint.transacted[credit_id]
+            if credit_id in checkpoint.written:
+                credit_updates.add_written(credits[credit_id], outcome)
+            elif outcome == 'credited':
+                credit_updates.add_credited(credit_id, credits[credit_id], nomis_transaction_id)
+            else:
+                credit_updates.add_set_manual(credit_id)
+        elif credit_id in credits:
+            credit_ids_by_prison.setdefault(credits[credit_id]['prison'], []).append(credit_id)
         else:
             logger.warning('Credit %(credit_id)s is no longer available', {'credit_id': credit_id})
-    logger.info('Credited %(count)d credits', {'count': credited})
+            credit_updates.add_failed(credit_id)
+    # interleave prisons so that workers are not held up waiting on one prison's limit
+    credit_ids = [
+        credit_id
+        for credit_id in chain.from_iterable(zip_longest(*credit_ids_by_prison.values()))
+        if credit_id is not None
+    ]
+    prison_semaphores = {
+        prison: BoundedSemaphore(settings.NOMIS_CREDITING_WORKERS_PER_PRISON)
+        for prison in credit_ids_by_prison
+    }
+
+    def credit_to_nomis(credit_id):
+        credit = credits[credit_id]
+        with prison_semaphores[credit['prison']]:
+            credit_credit_to_nomis(credit_id, credit, credit_updates)
+
+    with credit_updates:
+        if credit_ids:
+            with ThreadPoolExecutor(
+                max_workers=min(settings.NOMIS_CREDITING_WORKERS, len(credit_ids)),
+                thread_name_prefix='nomis-credit',
+            ) as executor:
+                list(executor.map(credit_to_nomis, credit_ids))
+    unwritten_ids = checkpoint.unwritten_ids
+    if unwritten_ids:
+        # kept so that crediting these credits again does not call NOMIS again
+        logger.error('Credits %(credit_ids)s were sent to NOMIS but could not be updated in the API', {
+            'credit_ids': ', '.join(map(str, sorted(unwritten_ids))),
+        })
+        checkpoint.close()
+    else:
+        checkpoint.remove()
+    logger.info('Credited %(count)d credits', {'count': len(credit_ids)})
 
     if settings.PRISONER_CAPPING_ENABLED:
-        prisoner_locations = set(
-            (credit['prison'], credit['prisoner_number'])
-            for credit in credits.values()
-        )
-        for prison, prisoner_number in prisoner_locations:
-            check_balance_is_below_cap(prison, prisoner_number)
+        check_balances_are_below_cap(credit_updates.credited_prisoners)
+
+
+@spoolable(body_params=('user', 'user_session',))
+def delete_credit_batch(*, user, user_session, batch_id):
+    api_session = get_api_session_with_session(user, user_session)
+    try:
+        api_session.delete(f'credits/batches/{batch_id}/')
+    except RequestException:
+        logger.exception('Credit batch %(batch_id)s could not be deleted', {'batch_id': batch_id})
 
 
 @spoolable()
 def credit_individual_credit_to_nomis(user, user_session, credit_id, credit):
-    api_session = get_api_session_with_session(user, user_session)
+    # credits spooled individually before they were credited concurrently by `credit_selected_credits_to_nomis`
+    with CreditUpdates(user, user_session) as credit_updates:
+        credit_credit_to_nomis(credit_id, credit, credit_updates)
+
+
+def credit_credit_to_nomis(credit_id, credit, credit_updates):
+    """
+    Sends a credit to NOMIS, leaving the API to be updated with the outcome by `credit_updates`
+    """
     if not hasattr(thread_local, 'nomis_session'):
         thread_local.nomis_session = requests.Session()
 
+    if not nomis_circuit_breaker.allow_request():
+        logger.warning('Credit %(credit_id)s was not credited as NOMIS is unavailable', {'credit_id': credit_id})
+        credit_updates.add_failed(credit_id)
+        return
+
     nomis_response = None
     try:
         nomis_response = nomis.create_transaction(
@@ -61,49 +467,124 @@ def credit_individual_credit_to_nomis(user, user_session, credit_id, credit):
             logger.warning('Credit %(credit_id)s was already present in NOMIS', {'credit_id': credit_id})
         elif e.response.status_code >= 500:
             logger.error('Credit %(credit_id)s could not credited as NOMIS is unavailable', {'credit_id': credit_id})
+            nomis_circuit_breaker.record_failure()
+            credit_updates.add_failed(credit_id)
             return
         else:
+            nomis_circuit_breaker.record_success()
             logger.warning('Credit %(credit_id)s cannot be automatically credited to NOMIS', {'credit_id': credit_id})
-            api_session.post(
-                'credits/actions/setmanual/',
-                json={'credit_ids': [int(credit_id)]}
-            )
+            # prisoner has probably moved so their location should be looked up afresh
+            invalidate_prisoner_location(credit['prisoner_number'])
+            credit_updates.add_set_manual(credit_id)
             return
     except RequestException:
         logger.exception('Credit %(credit_id)s could not credited as NOMIS is unavailable', {'credit_id': credit_id})
+        nomis_circuit_breaker.record_failure()
+        credit_updates.add_failed(credit_id)
         return
 
-    credit_update = {'id': credit_id, 'credited': True}
-    if nomis_response and 'id' in nomis_response:
-        credit_update['nomis_transaction_id'] = nomis_response['id']
-    api_session.post('credits/actions/credit/', json=[credit_update])
+    nomis_circuit_breaker.record_success()
+    nomis_transaction_id = nomis_response.get('id') if nomis_response else None
+    credit_updates.add_credited(credit_id, credit, nomis_transaction_id)
+
 
-    if credit.get('sender_email'):
+@spoolable(body_params=('credits',))
+def send_credited_confirmations(*, credits, retry_attempts=2, spoolable_ctx: Context = None):
+    """
+    Sends confirmation emails to senders of credited credits using GOV.UK Notify.
+    Emails are deduplicated by reference for CREDITED_CONFIRMATION_DEDUPLICATION_PERIOD seconds
+    and, like `mtp_common.tasks.send_email`, those failing with a temporary error are spooled again
+    up to `retry_attempts` times.
+    :param credits: dict of credits with sender emails keyed by id
+    """
+    cache = caches['credited_confirmations']
+    client = NotifyClient.shared_client()
+    retry_credits = {}
+    for credit_id, credit in credits.items():
+        reference = f'credited-{credit_id}'
+        if cache.get(reference):
+            logger.info('Confirmation email %(reference)s was already sent', {'reference': reference})
+            continue
         ref_number = credit.get('short_payment_ref') or ''
         prisoner_name = credit.get('intended_recipient') or ''
-        send_email(
-            template_name='cashbook-credited-confirmation',
-            to=credit['sender_email'],
-            personalisation={
-                'amount': format_currency(credit['amount']),
-                'has_ref_number': 'yes' if ref_number else 'no',
-                'ref_number': ref_number,
-                'received_at': format_date(credit['received_at'], 'd/m/Y'),
-                'has_prisoner_name': 'yes' if prisoner_name else 'no',
-                'prisoner_name': prisoner_name,
-                'help_url': urljoin(settings.SEND_MONEY_URL, '/help/'),
-                'site_url': settings.START_PAGE_URL,
-            },
-            reference=f'credited-{credit_id}',
-            staff_email=False,
-        )
+        try:
+            client.send_email(
+                template_name='cashbook-credited-confirmation',
+                to=credit['sender_email'],
+                personalisation={
+                    'amount': format_currency(credit['amount']),
+                    'has_ref_number': 'yes' if ref_number else 'no',
+                    'ref_number': ref_number,
+                    'received_at': format_date(credit['received_at'], 'd/m/Y'),
+                    'has_prisoner_name': 'yes' if prisoner_name else 'no',
+                    'prisoner_name': prisoner_name,
+                    'help_url': urljoin(settings.SEND_MONEY_URL, '/help/'),
+                    'site_url': settings.START_PAGE_URL,
+                },
+                reference=reference,
+                staff_email=False,
+            )
+        except APIError as e:
+            if 500 <= e.status_code < 600 and not isinstance(e, InvalidResponse):
+                retry_credits[credit_id] = credit
+            else:
+                logger.exception('Confirmation email %(reference)s could not be sent', {'reference': reference})
+        else:
+            # only recorded once sent so that an email is not lost if the spooler stops part-way through
+            cache.set(reference, True, timeout=settings.CREDITED_CONFIRMATION_DEDUPLICATION_PERIOD)
+
+    if retry_credits:
+        # no retry without uWSGI spooler
+        if spoolable_ctx.spooled and retry_attempts:
+            send_credited_confirmations(credits=retry_credits, retry_attempts=retry_attempts - 1)
+        else:
+            logger.error('%(count)d confirmation emails could not be sent as GOV.UK Notify is unavailable', {
+                'count': len(retry_credits),
+            })
 
 
 NOMIS_ACCOUNTS = {'cash', 'spends', 'savings'}
 
 
+def check_balances_are_below_cap(prisoners):
+    """
+    Checks NOMIS balances of credited prisoners concurrently, skipping those
+    successfully checked in the last PRISONER_CAPPING_CHECK_PERIOD seconds
+    :param prisoners: iterable of (prison, prisoner_number) pairs
+    """
+    cache = caches['prisoner_cap_checks']
+    prisoners = [
+        (prison, prisoner_number)
+        for prison, prisoner_number in sorted(prisoners)
+        if not cache.get(f'prisoner-cap-check-{prison}-{prisoner_number}')
+    ]
+    if not prisoners:
+        return
+
+    def check_prisoner(prisoner):
+        prison, prisoner_number = prisoner
+        if check_prisoner_balance_is_below_cap(prison, prisoner_number):
+            cache.set(f'prisoner-cap-check-{prison}-{prisoner_number}', True,
+                      timeout=settings.PRISONER_CAPPING_CHECK_PERIOD)
+
+    with ThreadPoolExecutor(
+        max_workers=min(settings.NOMIS_CREDITING_WORKERS, len(prisoners)),
+        thread_name_prefix='nomis-balance',
+    ) as executor:
+        list(executor.map(check_prisoner, prisoners))
+
+
 @spoolable()
 def check_balance_is_below_cap(prison, prisoner_number):
+    # balance checks spooled individually before they were made by `check_balances_are_below_cap`
+    check_prisoner_balance_is_below_cap(prison, prisoner_number)
+
+
+def check_prisoner_balance_is_below_cap(prison, prisoner_number):
+    """
+    Logs an error if a prisoner's NOMIS balance exceeds the cap
+    :return: whether the balance could be checked
+    """
     # NB: balances are not known in private estate currently, but cashbook is not used in there
     try:
         nomis_account_balances = nomis.get_account_balances(prison, prisoner_number)
@@ -117,11 +598,13 @@ def check_balance_is_below_cap(prison, prisoner_number):
             'NOMIS balances for %(prisoner_number)s is malformed',
             {'prisoner_number': prisoner_number, 'exception': e}
         )
+        return False
     except requests.RequestException:
         logger.exception(
             'Cannot lookup NOMIS balances for %(prisoner_number)s',
             {'prisoner_number': prisoner_number}
         )
+        return False
     else:
         prisoner_account_balance = sum(nomis_account_balances[account] for account in NOMIS_ACCOUNTS)
         if prisoner_account_balance > settings.PRISONER_CAPPING_THRESHOLD_IN_POUNDS * 100:
@@ -129,3 +612,4 @@ def check_balance_is_below_cap(prison, prisoner_number):
                 'NOMIS account balance for %(prisoner_number)s exceeds cap',
                 {'prisoner_number': prisoner_number}
             )
+        return True
@@ -1,9 +1,13 @@
 import copy
+import os
+import shutil
+import tempfile
 from unittest import mock
 from urllib.parse import urljoin
 
 from django.conf import settings
-from django.test import SimpleTestCase
+from django.core.cache import caches
+from django.test import SimpleTestCase, override_settings
 from django.urls import reverse
 from django.utils.functional import cached_property
 from mtp_common.auth.test_utils import generate_tokens
@@ -21,11 +25,31 @@ class MTPBaseTestCase(SimpleTestCase):
         'disbursements:search', 'disbursements:paper-forms', 'disbursements:process-overview',
     ]
 
+    @classmethod
+    def setUpClass(cls):
+        # file-based caches and crediting checkpoints are kept apart from those of the app
+        shared_dir = tempfile.mkdtemp(prefix='mtp-cashbook-tests-')
+        cls.addClassCleanup(shutil.rmtree, shared_dir, ignore_errors=True)
+        shared_dir_settings = override_settings(
+            SHARED_CACHE_DIR=shared_dir,
+            CREDITING_CHECKPOINT_DIR=os.path.join(shared_dir, 'checkpoints'),
+            CACHES={
+                alias: dict(config, LOCATION=os.path.join(shared_dir, os.path.basename(config['LOCATION'])))
+                if config['BACKEND'].endswith('.FileBasedCache') else config
+                for alias, config in settings.CACHES.items()
+            },
+        )
+        shared_dir_settings.enable()
+        cls.addClassCleanup(shared_dir_settings.disable)
+        super().setUpClass()
+
     def setUp(self):
         super().setUp()
         self.notifications_mock = mock.patch('mtp_common.templatetags.mtp_common.notifications_for_request',
                                              return_value=[])
         self.notifications_mock.start()
+        for cache in caches.all():
+            cache.clear()
 
     def tearDown(self):
         self.notifications_mock.stop()
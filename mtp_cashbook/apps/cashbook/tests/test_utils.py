@@ -0,0 +1,70 @@
+import datetime
+from unittest import mock
+
+from django.test import SimpleTestCase
+from django.utils import timezone
+
+from mtp_cashbook import utils
+from mtp_cashbook.utils import LazyDateFields, parse_date_value
+
+
+class ParseDateValueTestCase(SimpleTestCase):
+    def test_aware_datetime_converted_to_current_time_zone(self):
+        with timezone.override('Europe/London'):
+            value = parse_date_value('2017-06-25T12:00:00Z')
+        self.assertEqual(value, datetime.datetime(2017, 6, 25, 12, tzinfo=datetime.timezone.utc))
+        self.assertEqual(value.hour, 13)
+        self.assertEqual(str(value.tzinfo), 'Europe/London')
+
+    def test_date_parsed_as_date(self):
+        value = parse_date_value('2017-06-25')
+        self.assertIs(type(value), datetime.date)
+        self.assertEqual(value, datetime.date(2017, 6, 25))
+
+    def test_unparsable_values_returned_unchanged(self):
+        for value in ('', 'yesterday', '2017-13-45', '2017-06-25T25:00:00Z', None, 123):
+            self.assertIs(parse_date_value(value), value)
+        date = datetime.date(2017, 6, 25)
+        self.assertIs(parse_date_value(date), date)
+
+    def test_memoised_per_time_zone(self):
+        value = '2017-06-25T12:00:00Z'
+        with mock.patch.object(utils, 'parse_datetime', wraps=utils.parse_datetime) as mock_parse_datetime:
+            utils._parse_date_value.cache_clear()
+            with timezone.override('Europe/London'):
+                london_value = parse_date_value(value)
+                self.assertEqual(parse_date_value(value), london_value)
+            self.assertEqual(mock_parse_datetime.call_count, 1)
+
+            with timezone.override('UTC'):
+                utc_value = parse_date_value(value)
+            self.assertEqual(mock_parse_datetime.call_count, 2)
+        self.assertEqual(london_value.hour, 13)
+        self.assertEqual(utc_value.hour, 12)
+
+
+class LazyDateFieldsTestCase(SimpleTestCase):
+    def test_date_fields_converted_when_accessed(self):
+        data = LazyDateFields({
+            'received_at': '2017-06-25T12:00:00Z',
+            'credited_at': '2017-06-26',
+            'prisoner_number': '2017-06-25',
+        }, ('received_at', 'credited_at', 'set_manual_at'))
+        # not converted up-front
+        self.assertEqual(dict.__getitem__(data, 'received_at'), '2017-06-25T12:00:00Z')
+
+        self.assertEqual(data['received_at'], datetime.datetime(2017, 6, 25, 12, tzinfo=datetime.timezone.utc))
+        self.assertEqual(data.get('credited_at'), datetime.date(2017, 6, 26))
+        # converted values are kept
+        self.assertIsInstance(dict.__getitem__(data, 'received_at'), datetime.datetime)
+        # other fields are left as they are
+        self.assertEqual(data['prisoner_number'], '2017-06-25')
+        self.assertIsNone(data.get('set_manual_at'))
+        self.assertEqual(data.get('set_manual_at', 'missing'), 'missing')
+        with self.assertRaises(KeyError):
+            data['set_manual_at']
+
+    def test_unparsable_date_fields_returned_unchanged(self):
+        data = LazyDateFields({'received_at': 'unknown', 'credited_at': None}, ('received_at', 'credited_at'))
+        self.assertEqual(data['received_at'], 'unknown')
+        self.assertIsNone(data.get('credited_at'))
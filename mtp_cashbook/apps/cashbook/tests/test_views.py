@@ -1,13 +1,24 @@
+import copy
 import json
-from datetime import datetime
+from datetime import datetime, timezone
+import hashlib
 from unittest import mock
+from urllib.parse import urlencode
 import logging
+import os
+import threading
+import time
 
+from django.conf import settings
 from django.core import mail
+from django.core.cache import caches
 from django.test import override_settings
 from django.urls import reverse
+from django.utils.html import escape
+from mtp_common.auth.exceptions import HttpClientError, HttpServerError
 from mtp_common.test_utils import silence_logger
 from mtp_common.test_utils.notify import NotifyMock, GOVUK_NOTIFY_TEST_API_KEY
+import requests
 from requests.exceptions import HTTPError
 import responses
 
@@ -16,7 +27,17 @@ from cashbook.tests import (
     MTPBaseTestCase,
     wrap_response_data,
 )
-from mtp_cashbook.utils import one_month_ago
+from cashbook.tasks import (
+    CreditingCheckpoint, CreditUpdates,
+    credit_credit_to_nomis, credit_selected_credits_to_nomis, nomis_circuit_breaker, send_credited_confirmations,
+    unpack_credits,
+)
+from cashbook.utils import (
+    PendingCredit, PendingCreditChanges,
+    get_crediting_progress, load_credit_snapshot, publish_crediting_progress, save_credit_snapshot,
+    start_crediting_progress,
+)
+from mtp_cashbook.utils import get_prisoner_location, invalidate_prisoner_location, one_month_ago
 
 CREDIT_1 = {
     'id': 1,
@@ -31,6 +52,7 @@ CREDIT_1 = {
     'owner': 100,
     'owner_name': 'Staff 1',
     'set_manual_at': '2017-01-26T12:00:00Z',
+    'resolution': 'pending',
 }
 CREDIT_2 = {
     'id': 2,
@@ -45,6 +67,7 @@ CREDIT_2 = {
     'owner': 100,
     'owner_name': 'Staff 1',
     'set_manual_at': '2017-01-26T12:00:00Z',
+    'resolution': 'pending',
 }
 PROCESSING_BATCH = {
     'id': 10,
@@ -80,26 +103,697 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 json=wrap_response_data(),
                 status=200,
             )
-            # get new credits
+            # get new and manual credits
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
                 json=wrap_response_data(CREDIT_1, CREDIT_2),
                 status=200,
                 match_querystring=True,
             )
-            # get manual credits
+            self.login()
+            response = self.client.get(self.url, follow=True)
+            self.assertContains(response, '52.00')
+            self.assertContains(response, '45.00')
+
+    @override_settings(REQUEST_PAGE_SIZE=1)
+    def test_new_credits_display_multiple_pages(self):
+        credits = [
+            dict(CREDIT_1, id=credit_id, amount=credit_id * 100 + 1)
+            for credit_id in range(1, 5)
+        ]
+        with responses.RequestsMock() as rsps:
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
+                api_url('/credits/batches/'),
                 json=wrap_response_data(),
                 status=200,
+            )
+            # get new and manual credits, one page at a time
+            for offset, credit in enumerate(credits):
+                rsps.add(
+                    rsps.GET,
+                    api_url('/credits/?ordering=-received_at&offset=%d&limit=1&status=credit_pending' % offset),
+                    json={'count': len(credits), 'results': [credit]},
+                    status=200,
+                    match_querystring=True,
+                )
+            self.login()
+            response = self.client.get(self.url)
+        content = response.content.decode()
+        positions = [content.index(f'£{credit_id}.01') for credit_id in range(1, 5)]
+        self.assertListEqual(positions, sorted(positions), msg='Pages should be reassembled in order')
+
+    def test_new_credits_reordered_without_reloading(self):
+        credits = [
+            dict(CREDIT_1, id=1, amount=101, prisoner_number='A1234AA', received_at='2017-01-25T15:00:00Z'),
+            dict(CREDIT_1, id=2, amount=201, prisoner_number='A1234CC', received_at='2017-01-25T14:00:00.5Z'),
+            dict(CREDIT_1, id=3, amount=301, prisoner_number='A1234BB', received_at='2017-01-25T14:00:00Z'),
+        ]
+        with responses.RequestsMock() as rsps:
+            for _ in range(3):
+                rsps.add(
+                    rsps.GET,
+                    api_url('/credits/batches/'),
+                    json=wrap_response_data(),
+                    status=200,
+                )
+            # get new and manual credits once
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                json=wrap_response_data(*credits),
+                status=200,
                 match_querystring=True,
             )
             self.login()
-            response = self.client.get(self.url, follow=True)
-            self.assertContains(response, '52.00')
-            self.assertContains(response, '45.00')
+            credit_set_token = None
+            for ordering, expected_order in [('-received_at', [1, 2, 3]),
+                                             ('amount', [1, 2, 3]),
+                                             ('-prisoner_number', [2, 3, 1])]:
+                params = {'ordering': ordering}
+                if credit_set_token:
+                    # as in links to re-order the page
+                    params['credit_set'] = credit_set_token
+                response = self.client.get(self.url, params)
+                credit_set_token = response.context['request_params']['credit_set']
+                content = response.content.decode()
+                positions = [content.index(f'£{credit_id}.01') for credit_id in expected_order]
+                self.assertListEqual(positions, sorted(positions), msg=f'Credits should be ordered by {ordering}')
+            self.assertIn(f'credit_set={credit_set_token}', content)
+
+    def test_new_credits_reloaded_afresh(self):
+        with responses.RequestsMock() as rsps:
+            for _ in range(2):
+                rsps.add(
+                    rsps.GET,
+                    api_url('/credits/batches/'),
+                    json=wrap_response_data(),
+                    status=200,
+                )
+            # get new and manual credits, a credit arrives before the page is reloaded
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                json=wrap_response_data(CREDIT_1),
+                status=200,
+                match_querystring=True,
+            )
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                json=wrap_response_data(CREDIT_1, CREDIT_2),
+                status=200,
+                match_querystring=True,
+            )
+            self.login()
+            response = self.client.get(self.url)
+            self.assertNotContains(response, CREDIT_2['prisoner_number'])
+            response = self.client.get(self.url)
+            self.assertContains(response, CREDIT_2['prisoner_number'])
+
+    def test_new_credits_display_multiple_prisons(self):
+        login_data = copy.deepcopy(self._default_login_data)
+        login_data['user_data']['prisons'].append({
+            'nomis_id': 'LEI',
+            'name': 'HMP Leeds',
+            'pre_approval_required': False,
+        })
+        prison_credits = {
+            'BXI': [
+                dict(CREDIT_1, id=1, amount=101, received_at='2017-01-25T15:00:00Z'),
+                dict(CREDIT_1, id=3, amount=301, received_at='2017-01-25T12:00:00Z'),
+            ],
+            'LEI': [
+                dict(CREDIT_2, id=2, amount=201, prison='LEI', received_at='2017-01-25T14:00:00Z'),
+                dict(CREDIT_2, id=4, amount=401, prison='LEI', received_at='2017-01-25T11:00:00Z'),
+            ],
+        }
+        with responses.RequestsMock() as rsps:
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/batches/'),
+                json=wrap_response_data(),
+                status=200,
+            )
+            # get new and manual credits for each prison separately
+            for prison, credits in prison_credits.items():
+                rsps.add(
+                    rsps.GET,
+                    api_url(
+                        '/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&prison=%s' % prison
+                    ),
+                    json=wrap_response_data(*credits),
+                    status=200,
+                    match_querystring=True,
+                )
+            self.login(login_data=login_data)
+            response = self.client.get(self.url)
+        content = response.content.decode()
+        positions = [content.index(f'£{credit_id}.01') for credit_id in range(1, 5)]
+        self.assertListEqual(positions, sorted(positions), msg='Prisons should be merged in order')
+
+    @override_settings(NEW_CREDITS_WINDOW_SIZE=2)
+    def test_new_credits_display_window(self):
+        credits = [
+            dict(CREDIT_1, id=credit_id, amount=credit_id * 100 + 1)
+            for credit_id in range(1, 4)
+        ]
+        with responses.RequestsMock() as rsps:
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/batches/'),
+                json=wrap_response_data(),
+                status=200,
+            )
+            # get new and manual credits, the next window is loaded from the snapshot of the page
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                json=wrap_response_data(*credits),
+                status=200,
+                match_querystring=True,
+            )
+            self.login()
+            response = self.client.get(self.url)
+            self.assertContains(response, '£1.01')
+            self.assertContains(response, '£2.01')
+            self.assertNotContains(response, '£3.01')
+            self.assertContains(response, '<strong>3</strong> new credits')
+            snapshot_token = response.context['snapshot_token']
+            next_window_url = reverse('new-credits-window') + '?' + urlencode({
+                'ordering': '-received_at', 'snapshot': snapshot_token, 'offset': 2,
+            })
+            self.assertContains(response, f'data-url="{escape(next_window_url)}"')
+            # a printout says that it is incomplete
+            self.assertContains(response, 'Only the first 2 of 3 new credits are listed')
+
+            response = self.client.get(next_window_url)
+            self.assertContains(response, '£3.01')
+            self.assertNotContains(response, '£1.01')
+            self.assertNotContains(response, 'data-url=')
+            # credits were not loaded again
+            self.assertEqual(len(rsps.calls), 2)
+
+        # once the snapshot has expired, the link to show all credits is left in place
+        caches['credit_snapshots'].clear()
+        response = self.client.get(next_window_url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_new_credits_changes(self):
+        added_credit = dict(CREDIT_2, id=3, amount=1234, received_at='2017-01-27T12:00:00Z')
+        token = PendingCreditChanges.make_token(
+            [PendingCredit(**CREDIT_1)], since=datetime(2017, 1, 26, 12, tzinfo=timezone.utc),
+        )
+        user = mock.Mock(pk=100)
+        snapshot_token = save_credit_snapshot(user, {
+            credit['id']: PendingCredit(**credit)
+            for credit in (CREDIT_1, CREDIT_2)
+        })
+        with responses.RequestsMock() as rsps:
+            # get credits received since the watermark
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?status=credit_pending&resolution=pending&ordering=received_at'
+                        '&received_at__gte=2017-01-25T12%3A00%3A00%2B00%3A00&offset=0&limit=100'),
+                json=wrap_response_data(CREDIT_1, added_credit),
+                status=200,
+                match_querystring=True,
+            )
+            # get credits resolved since the watermark, including some not shown on the page
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?log__action=credited&logged_at__gte=2017-01-26T11%3A59%3A00%2B00%3A00'
+                        '&offset=0&limit=100'),
+                json=wrap_response_data(CREDIT_2, dict(CREDIT_2, id=9, resolution='manual')),
+                status=200,
+                match_querystring=True,
+            )
+            # totals are worked out without loading every pending credit again
+            self.login()
+            response = self.client.get(reverse('new-credits-changes'), {'token': token, 'snapshot': snapshot_token})
+        self.assertEqual(response.status_code, 200)
+        changes = response.json()
+        self.assertListEqual(changes['added'], [3])
+        self.assertListEqual(changes['resolved'], [2])
+        self.assertEqual(changes['count'], 2)
+        self.assertEqual(changes['credit_ids_digest'], hashlib.sha256(b'1,3').hexdigest())
+        self.assertIn('data-credit-id="3"', changes['rows'])
+        self.assertIn('£12.34', changes['rows'])
+        self.assertNotIn('data-credit-id="1"', changes['rows'])
+        # changes are merged into a new snapshot in the page's ordering
+        snapshot = load_credit_snapshot(user, changes['snapshot'])
+        self.assertListEqual(list(snapshot), [3, 1])
+
+        with responses.RequestsMock() as rsps:
+            # nothing since the new watermark
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/'),
+                json=wrap_response_data(added_credit),
+                status=200,
+            )
+            # credits already resolved are reported again within the overlap
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/'),
+                json=wrap_response_data(CREDIT_2),
+                status=200,
+            )
+            response = self.client.get(
+                reverse('new-credits-changes'), {'token': changes['token'], 'snapshot': changes['snapshot']}
+            )
+            self.assertIn('received_at__gte=2017-01-27T12%3A00%3A00%2B00%3A00', rsps.calls[0].request.url)
+        changes = response.json()
+        self.assertListEqual(changes['added'], [])
+        self.assertListEqual(changes['resolved'], [])
+        self.assertNotIn('rows', changes)
+        # the snapshot is kept for longer
+        self.assertListEqual(list(load_credit_snapshot(user, changes['snapshot'])), [3, 1])
+
+        # once the snapshot has expired, the page stops checking for changes
+        caches['credit_snapshots'].clear()
+        response = self.client.get(
+            reverse('new-credits-changes'), {'token': changes['token'], 'snapshot': changes['snapshot']}
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_new_credits_changes_with_invalid_token(self):
+        self.login()
+        snapshot_token = save_credit_snapshot(mock.Mock(pk=100), {1: PendingCredit(**CREDIT_1)})
+        response = self.client.get(reverse('new-credits-changes'), {'token': 'invalid', 'snapshot': snapshot_token})
+        self.assertEqual(response.status_code, 400)
+
+    @mock.patch('cashbook.forms.credit_selected_credits_to_nomis')
+    def test_new_credits_submit_all_selected(self, mock_credit_selected_credits_to_nomis):
+        with responses.RequestsMock() as rsps:
+            # get new and manual credits
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                json=wrap_response_data(CREDIT_1, CREDIT_2),
+                status=200,
+                match_querystring=True,
+            )
+            # check selected credits are still pending
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?status=credit_pending&resolution=pending&pk=1&pk=2&offset=0&limit=100'),
+                json=wrap_response_data(CREDIT_1, CREDIT_2),
+                status=200,
+                match_querystring=True,
+            )
+            # create batch
+            rsps.add(
+                rsps.POST,
+                api_url('/credits/batches/'),
+                status=201,
+            )
+
+            self.login()
+            # only the first credit was loaded into the page, but all were selected
+            response = self.client.post(
+                self.url,
+                data={
+                    'credits': [1], 'submit_new': 'submit',
+                    'select_all': hashlib.sha256(b'1,2').hexdigest(),
+                },
+            )
+            self.assertRedirects(response, self.url, fetch_redirect_response=False)
+            self.assertCountEqual(json.loads(rsps.calls[2].request.body)['credits'], [1, 2])
+        self.assertCountEqual(mock_credit_selected_credits_to_nomis.call_args[1]['selected_credit_ids'], [1, 2])
+
+    @mock.patch('cashbook.forms.credit_selected_credits_to_nomis')
+    def test_new_credits_submit_all_selected_with_exclusions(self, mock_credit_selected_credits_to_nomis):
+        credits = [dict(CREDIT_1, id=credit_id) for credit_id in range(1, 5)]
+        with responses.RequestsMock() as rsps:
+            # get new and manual credits
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                json=wrap_response_data(*credits),
+                status=200,
+                match_querystring=True,
+            )
+            # check selected credits are still pending
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?status=credit_pending&resolution=pending&pk=1&pk=3&offset=0&limit=100'),
+                json=wrap_response_data(credits[0], credits[2]),
+                status=200,
+                match_querystring=True,
+            )
+            # create batch
+            rsps.add(
+                rsps.POST,
+                api_url('/credits/batches/'),
+                status=201,
+            )
+
+            self.login()
+            # no credit ids are submitted, only exclusions
+            response = self.client.post(
+                self.url,
+                data={
+                    'submit_new': 'submit',
+                    'select_all': hashlib.sha256(b'1,2,3,4').hexdigest(),
+                    'excluded': '2,4',
+                },
+            )
+            self.assertRedirects(response, self.url, fetch_redirect_response=False)
+            self.assertCountEqual(json.loads(rsps.calls[2].request.body)['credits'], [1, 3])
+        self.assertCountEqual(mock_credit_selected_credits_to_nomis.call_args[1]['selected_credit_ids'], [1, 3])
+
+    @override_settings(CREDITING_BATCH_CHUNK_SIZE=2)
+    @mock.patch('cashbook.forms.credit_selected_credits_to_nomis')
+    def test_new_credits_submit_in_chunks(self, mock_credit_selected_credits_to_nomis):
+        credits = [dict(CREDIT_1, id=credit_id) for credit_id in range(1, 4)]
+        with responses.RequestsMock() as rsps:
+            # get new and manual credits
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                json=wrap_response_data(*credits),
+                status=200,
+                match_querystring=True,
+            )
+            # check selected credits are still pending
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?status=credit_pending&resolution=pending&pk=1&pk=2&pk=3&offset=0&limit=100'),
+                json=wrap_response_data(*credits),
+                status=200,
+                match_querystring=True,
+            )
+            # create one batch for the whole selection
+            rsps.add(
+                rsps.POST,
+                api_url('/credits/batches/'),
+                status=201,
+            )
+
+            self.login()
+            response = self.client.post(
+                self.url,
+                data={'credits': [1, 2, 3], 'submit_new': 'submit'},
+            )
+            self.assertRedirects(response, self.url, fetch_redirect_response=False)
+            self.assertListEqual(json.loads(rsps.calls[2].request.body)['credits'], [1, 2, 3])
+        chunks = [
+            (call[1]['selected_credit_ids'], sorted(unpack_credits(call[1]['credits'])))
+            for call in mock_credit_selected_credits_to_nomis.call_args_list
+        ]
+        self.assertListEqual(chunks, [([1, 2], [1, 2]), ([3], [3])])
+
+    @override_settings(REQUEST_PAGE_SIZE=2)
+    @mock.patch('cashbook.forms.credit_selected_credits_to_nomis')
+    def test_new_credits_submit_uses_current_state_of_credits(self, mock_credit_selected_credits_to_nomis):
+        credits = [dict(CREDIT_1, id=credit_id) for credit_id in range(1, 4)]
+        with responses.RequestsMock() as rsps:
+            # get new and manual credits
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=2&status=credit_pending'),
+                json={'count': 3, 'results': credits[:2]},
+                status=200,
+                match_querystring=True,
+            )
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=2&limit=2&status=credit_pending'),
+                json={'count': 3, 'results': credits[2:]},
+                status=200,
+                match_querystring=True,
+            )
+            # check selected credits are still pending, a few ids at a time; prisoner 3 has moved since
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?status=credit_pending&resolution=pending&pk=1&pk=2&offset=0&limit=2'),
+                json=wrap_response_data(*credits[:2]),
+                status=200,
+                match_querystring=True,
+            )
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?status=credit_pending&resolution=pending&pk=3&offset=0&limit=2'),
+                json=wrap_response_data(dict(credits[2], prison='LEI')),
+                status=200,
+                match_querystring=True,
+            )
+            # create one batch for the whole selection
+            rsps.add(
+                rsps.POST,
+                api_url('/credits/batches/'),
+                status=201,
+            )
+
+            self.login()
+            response = self.client.post(
+                self.url,
+                data={'credits': [1, 2, 3], 'submit_new': 'submit'},
+            )
+            self.assertRedirects(response, self.url, fetch_redirect_response=False)
+        spooled_credits = unpack_credits(mock_credit_selected_credits_to_nomis.call_args[1]['credits'])
+        self.assertDictEqual({credit_id: credit.prison for credit_id, credit in spooled_credits.items()}, {
+            1: 'BXI', 2: 'BXI', 3: 'LEI',
+        })
+
+    @mock.patch('cashbook.forms.credit_selected_credits_to_nomis')
+    def test_new_credits_submit_skips_already_processed(self, mock_credit_selected_credits_to_nomis):
+        with responses.RequestsMock() as rsps:
+            # get new and manual credits
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                json=wrap_response_data(CREDIT_1, CREDIT_2),
+                status=200,
+                match_querystring=True,
+            )
+            # check selected credits are still pending, but another clerk has credited one
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?status=credit_pending&resolution=pending&pk=1&pk=2&offset=0&limit=100'),
+                json=wrap_response_data(CREDIT_2),
+                status=200,
+                match_querystring=True,
+            )
+            # create batch
+            rsps.add(
+                rsps.POST,
+                api_url('/credits/batches/'),
+                status=201,
+            )
+
+            self.login()
+            response = self.client.post(
+                self.url,
+                data={'credits': [1, 2], 'submit_new': 'submit'},
+            )
+            self.assertRedirects(response, self.url, fetch_redirect_response=False)
+            self.assertListEqual(json.loads(rsps.calls[2].request.body)['credits'], [2])
+        self.assertListEqual(mock_credit_selected_credits_to_nomis.call_args[1]['selected_credit_ids'], [2])
+        self.assertListEqual(
+            [str(message) for message in response.wsgi_request._messages],
+            ['1 credit was skipped because someone else has already processed it'],
+        )
+
+    @mock.patch('cashbook.forms.credit_selected_credits_to_nomis')
+    def test_new_credits_submit_all_already_processed(self, mock_credit_selected_credits_to_nomis):
+        with responses.RequestsMock() as rsps:
+            # get new and manual credits
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                json=wrap_response_data(CREDIT_1, CREDIT_2),
+                status=200,
+                match_querystring=True,
+            )
+            # check selected credits are still pending, but another clerk has credited both
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?status=credit_pending&resolution=pending&pk=1&pk=2&offset=0&limit=100'),
+                json=wrap_response_data(),
+                status=200,
+                match_querystring=True,
+            )
+
+            self.login()
+            response = self.client.post(
+                self.url,
+                data={'credits': [1, 2], 'submit_new': 'submit'},
+            )
+            self.assertRedirects(response, self.url, fetch_redirect_response=False)
+        mock_credit_selected_credits_to_nomis.assert_not_called()
+
+    @mock.patch('cashbook.forms.credit_selected_credits_to_nomis')
+    def test_new_credits_submit_uses_snapshot(self, mock_credit_selected_credits_to_nomis):
+        merged_credit = dict(CREDIT_2, id=3, amount=1234)
+        with responses.RequestsMock() as rsps:
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/batches/'),
+                json=wrap_response_data(),
+                status=200,
+            )
+            # get new and manual credits when rendering the page
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                json=wrap_response_data(CREDIT_1, CREDIT_2),
+                status=200,
+                match_querystring=True,
+            )
+            # get only the selected credit that was merged into the page later
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?status=credit_pending&resolution=pending&pk=3&offset=0&limit=100'),
+                json=wrap_response_data(merged_credit),
+                status=200,
+                match_querystring=True,
+            )
+            # check selected credits are still pending
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?status=credit_pending&resolution=pending&pk=1&pk=3&offset=0&limit=100'),
+                json=wrap_response_data(CREDIT_1, merged_credit),
+                status=200,
+                match_querystring=True,
+            )
+            # create batch
+            rsps.add(
+                rsps.POST,
+                api_url('/credits/batches/'),
+                status=201,
+            )
+
+            self.login()
+            response = self.client.get(self.url)
+            snapshot_token = response.context['snapshot_token']
+            response = self.client.post(
+                self.url,
+                data={'credits': [1, 3], 'submit_new': 'submit', 'snapshot': snapshot_token},
+            )
+            self.assertRedirects(response, self.url, fetch_redirect_response=False)
+        task_kwargs = mock_credit_selected_credits_to_nomis.call_args[1]
+        self.assertCountEqual(task_kwargs['selected_credit_ids'], [1, 3])
+        # only fields needed for crediting are spooled
+        credit = unpack_credits(task_kwargs['credits'])[3]
+        self.assertEqual(credit.amount, 1234)
+        self.assertIsNone(credit.prisoner_name)
+
+    @override_settings(REQUEST_PAGE_SIZE=2)
+    @mock.patch('cashbook.forms.credit_selected_credits_to_nomis')
+    def test_new_credits_submit_loads_merged_credits_in_chunks(self, mock_credit_selected_credits_to_nomis):
+        merged_credits = [dict(CREDIT_2, id=credit_id) for credit_id in (3, 4, 5)]
+        snapshot_token = save_credit_snapshot(mock.Mock(pk=100), {1: PendingCredit(**CREDIT_1)})
+        with responses.RequestsMock() as rsps:
+            # get selected credits that were merged into the page later, a page's worth of ids at a time
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?status=credit_pending&resolution=pending&pk=3&pk=4&offset=0&limit=2'),
+                json=wrap_response_data(*merged_credits[:2]),
+                status=200,
+                match_querystring=True,
+            )
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?status=credit_pending&resolution=pending&pk=5&offset=0&limit=2'),
+                json=wrap_response_data(merged_credits[2]),
+                status=200,
+                match_querystring=True,
+            )
+            # check selected credits are still pending
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?status=credit_pending&resolution=pending&pk=1&pk=3&offset=0&limit=2'),
+                json=wrap_response_data(CREDIT_1, merged_credits[0]),
+                status=200,
+                match_querystring=True,
+            )
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?status=credit_pending&resolution=pending&pk=4&pk=5&offset=0&limit=2'),
+                json=wrap_response_data(*merged_credits[1:]),
+                status=200,
+                match_querystring=True,
+            )
+            # create batch
+            rsps.add(
+                rsps.POST,
+                api_url('/credits/batches/'),
+                status=201,
+            )
+
+            self.login()
+            response = self.client.post(
+                self.url,
+                data={'credits': [1, 3, 4, 5], 'submit_new': 'submit', 'snapshot': snapshot_token},
+            )
+            self.assertRedirects(response, self.url, fetch_redirect_response=False)
+        self.assertListEqual(mock_credit_selected_credits_to_nomis.call_args[1]['selected_credit_ids'], [1, 3, 4, 5])
+
+    def test_new_credits_submit_all_selected_when_credits_changed(self):
+        with responses.RequestsMock() as rsps:
+            # get new and manual credits
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                json=wrap_response_data(CREDIT_1, CREDIT_2, dict(CREDIT_2, id=3)),
+                status=200,
+                match_querystring=True,
+            )
+
+            self.login()
+            response = self.client.post(
+                self.url,
+                data={
+                    'credits': [1, 2], 'submit_new': 'submit',
+                    'select_all': hashlib.sha256(b'1,2').hexdigest(),
+                },
+            )
+            self.assertContains(response, 'The list of new credits has changed')
+
+    def test_new_credits_invalid_submission_selects_all_rendered_credits(self):
+        with responses.RequestsMock() as rsps:
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/batches/'),
+                json=wrap_response_data(),
+                status=200,
+            )
+            # get new and manual credits when rendering the page
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                json=wrap_response_data(CREDIT_1, CREDIT_2),
+                status=200,
+                match_querystring=True,
+            )
+
+            self.login()
+            response = self.client.get(self.url)
+            snapshot_token = response.context['snapshot_token']
+
+        with responses.RequestsMock() as rsps:
+            # get new and manual credits to render the page again, another has arrived since
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                json=wrap_response_data(CREDIT_1, CREDIT_2, dict(CREDIT_2, id=3)),
+                status=200,
+                match_querystring=True,
+            )
+            response = self.client.post(
+                self.url,
+                data={
+                    'submit_new': 'submit', 'snapshot': snapshot_token,
+                    'select_all': hashlib.sha256(b'1,2').hexdigest(), 'excluded': 'invalid',
+                },
+            )
+        self.assertContains(response, 'Select a valid choice')
+        # selecting all again selects the credits now shown
+        self.assertContains(response, f'data-value="{hashlib.sha256(b"1,2,3").hexdigest()}"')
+        self.assertNotContains(response, f'data-value="{hashlib.sha256(b"1,2").hexdigest()}"')
 
     @mock.patch(
         'cashbook.tasks.nomis.create_transaction',
@@ -108,19 +802,19 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
     )
     def test_new_credits_submit(self, mock_create_transaction):
         with NotifyMock() as rsps:
-            # get new credits
+            # get new and manual credits
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
                 json=wrap_response_data(CREDIT_1, CREDIT_2),
                 status=200,
                 match_querystring=True,
             )
-            # get manual credits
+            # check selected credits are still pending
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
-                json=wrap_response_data(),
+                api_url('/credits/?status=credit_pending&resolution=pending&pk=1&pk=2&offset=0&limit=100'),
+                json=wrap_response_data(CREDIT_1, CREDIT_2),
                 status=200,
                 match_querystring=True,
             )
@@ -130,11 +824,7 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 api_url('/credits/batches/'),
                 status=201,
             )
-            rsps.add(
-                rsps.POST,
-                api_url('/credits/actions/credit/'),
-                status=204,
-            )
+            # mark credits as credited in one request
             rsps.add(
                 rsps.POST,
                 api_url('/credits/actions/credit/'),
@@ -170,18 +860,10 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 api_url('/credits/batches/%s/' % PROCESSING_BATCH['id']),
                 status=200,
             )
-            # get new credits
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
-                json=wrap_response_data(),
-                status=200,
-                match_querystring=True,
-            )
-            # get manual credits
+            # get new and manual credits
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
                 json=wrap_response_data(),
                 status=200,
                 match_querystring=True,
@@ -194,17 +876,22 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 follow=True
             )
             self.assertEqual(response.status_code, 200)
-            expected_calls = [
-                [{'id': 1, 'credited': True, 'nomis_transaction_id': 'A1234BC-1'}],
-                [{'id': 2, 'credited': True, 'nomis_transaction_id': 'A1234GG-1'}]
-            ]
-            self.assertTrue(all(
-                json.loads(call.request.body.decode('utf-8')) in expected_calls
+            credit_calls = [
+                json.loads(call.request.body.decode('utf-8'))
                 for call in rsps.calls
                 if call.request.url.endswith('/credits/actions/credit/')
-            ))
+            ]
+            self.assertEqual(len(credit_calls), 1)
+            self.assertCountEqual(credit_calls[0], [
+                {'id': 1, 'credited': True, 'nomis_transaction_id': 'A1234BC-1'},
+                {'id': 2, 'credited': True, 'nomis_transaction_id': 'A1234GG-1'},
+            ])
 
-            request_nomis_session_used = mock_create_transaction.call_args_list[0][1]['session']
+            # credits are sent concurrently, each worker thread with its own session
+            self.assertTrue(all(
+                isinstance(call[1]['session'], requests.Session)
+                for call in mock_create_transaction.call_args_list
+            ))
             mock_create_transaction.assert_has_calls(
                 [
                     mock.call(
@@ -214,7 +901,7 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                         prisoner_number='A1234BC',
                         record_id='1',
                         retries=1,
-                        session=request_nomis_session_used,
+                        session=mock.ANY,
                         transaction_type='MTDS',
                     ),
                     mock.call(
@@ -224,7 +911,7 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                         prisoner_number='A1234GG',
                         record_id='2',
                         retries=1,
-                        session=request_nomis_session_used,
+                        session=mock.ANY,
                         transaction_type='MTDS',
                     ),
                 ],
@@ -282,19 +969,19 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
         mock_nomis.get_account_balances = get_account_balances
 
         with NotifyMock() as rsps:
-            # get new credits
+            # get new and manual credits
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
                 json=wrap_response_data(CREDIT_1, CREDIT_2),
                 status=200,
                 match_querystring=True,
             )
-            # get manual credits
+            # check selected credits are still pending
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
-                json=wrap_response_data(),
+                api_url('/credits/?status=credit_pending&resolution=pending&pk=1&pk=2&offset=0&limit=100'),
+                json=wrap_response_data(CREDIT_1, CREDIT_2),
                 status=200,
                 match_querystring=True,
             )
@@ -304,11 +991,7 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 api_url('/credits/batches/'),
                 status=201,
             )
-            rsps.add(
-                rsps.POST,
-                api_url('/credits/actions/credit/'),
-                status=204,
-            )
+            # mark credits as credited in one request
             rsps.add(
                 rsps.POST,
                 api_url('/credits/actions/credit/'),
@@ -344,18 +1027,10 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 api_url('/credits/batches/%s/' % PROCESSING_BATCH['id']),
                 status=200,
             )
-            # get new credits
+            # get new and manual credits
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
-                json=wrap_response_data(),
-                status=200,
-                match_querystring=True,
-            )
-            # get manual credits
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
                 json=wrap_response_data(),
                 status=200,
                 match_querystring=True,
@@ -390,19 +1065,19 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
     )
     def test_new_credits_submit_with_conflict(self, _):
         with NotifyMock() as rsps:
-            # get new credits
+            # get new and manual credits
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
                 json=wrap_response_data(CREDIT_1, CREDIT_2),
                 status=200,
                 match_querystring=True,
             )
-            # get manual credits
+            # check selected credits are still pending
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
-                json=wrap_response_data(),
+                api_url('/credits/?status=credit_pending&resolution=pending&pk=1&pk=2&offset=0&limit=100'),
+                json=wrap_response_data(CREDIT_1, CREDIT_2),
                 status=200,
                 match_querystring=True,
             )
@@ -412,11 +1087,7 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 api_url('/credits/batches/'),
                 status=201,
             )
-            rsps.add(
-                rsps.POST,
-                api_url('/credits/actions/credit/'),
-                status=204,
-            )
+            # mark credits as credited in one request
             rsps.add(
                 rsps.POST,
                 api_url('/credits/actions/credit/'),
@@ -452,18 +1123,10 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 api_url('/credits/batches/%s/' % PROCESSING_BATCH['id']),
                 status=200,
             )
-            # get new credits
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
-                json=wrap_response_data(),
-                status=200,
-                match_querystring=True,
-            )
-            # get manual credits
+            # get new and manual credits
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
                 json=wrap_response_data(),
                 status=200,
                 match_querystring=True,
@@ -497,19 +1160,19 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
     )
     def test_new_credits_submit_with_uncreditable(self, *_):
         with NotifyMock() as rsps:
-            # get new credits
+            # get new and manual credits
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
                 json=wrap_response_data(CREDIT_1, CREDIT_2),
                 status=200,
                 match_querystring=True,
             )
-            # get manual credits
+            # check selected credits are still pending
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
-                json=wrap_response_data(),
+                api_url('/credits/?status=credit_pending&resolution=pending&pk=1&pk=2&offset=0&limit=100'),
+                json=wrap_response_data(CREDIT_1, CREDIT_2),
                 status=200,
                 match_querystring=True,
             )
@@ -560,19 +1223,11 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 api_url('/credits/batches/%s/' % PROCESSING_BATCH['id']),
                 status=200,
             )
-            # get new credits
+            # get new and manual credits
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
-                json=wrap_response_data(),
-                status=200,
-                match_querystring=True,
-            )
-            # get manual credits
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
-                json=wrap_response_data(CREDIT_1),
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                json=wrap_response_data(dict(CREDIT_1, resolution='manual')),
                 status=200,
                 match_querystring=True,
             )
@@ -590,8 +1245,288 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
             self.assertEqual(len(mail.outbox), 0)
             self.assertEqual(len(rsps.send_email_calls), 1)
 
+    @override_settings(NOMIS_CREDITING_WORKERS=4, NOMIS_CREDITING_WORKERS_PER_PRISON=1)
+    def test_credits_sent_to_nomis_with_limited_concurrency_per_prison(self):
+        credits = {
+            credit_id: dict(CREDIT_1, id=credit_id, prison='BXI' if credit_id % 2 else 'LEI')
+            for credit_id in range(1, 7)
+        }
+        lock = threading.Lock()
+        concurrency = {'BXI': 0, 'LEI': 0}
+        max_concurrency = dict(concurrency)
+        credited = []
+
+        def credit_credit_to_nomis(credit_id, credit, credit_updates):
+            prison = credit['prison']
+            with lock:
+                concurrency[prison] += 1
+                max_concurrency[prison] = max(max_concurrency[prison], concurrency[prison])
+            time.sleep(0.01)
+            with lock:
+                concurrency[prison] -= 1
+                credited.append(credit_id)
+
+        with mock.patch('cashbook.tasks.credit_credit_to_nomis', side_effect=credit_credit_to_nomis):
+            credit_selected_credits_to_nomis(
+                user=None, user_session={},
+                selected_credit_ids=list(credits) + [7],
+                credits=credits,
+            )
+        self.assertCountEqual(credited, range(1, 7))
+        self.assertDictEqual(max_concurrency, {'BXI': 1, 'LEI': 1})
+
+    @override_settings(
+        NOMIS_CREDITING_WORKERS=1,
+        NOMIS_CIRCUIT_BREAKER_FAILURE_THRESHOLD=2,
+        NOMIS_CIRCUIT_BREAKER_RESET_TIMEOUT=30,
+    )
+    @mock.patch('cashbook.tasks.nomis.create_transaction')
+    def test_nomis_circuit_breaker_fails_credits_fast(self, mock_create_transaction):
+        credits = {credit_id: dict(CREDIT_1, id=credit_id) for credit_id in range(1, 5)}
+        credit_updates = CreditUpdates(user=None, user_session={})
+        credit_updates.flush = mock.Mock()
+
+        # NOMIS is unavailable so the circuit opens after 2 failures and remaining credits are not attempted
+        mock_create_transaction.side_effect = HTTPError(response=mock.Mock(status_code=503))
+        with silence_logger():
+            for credit_id, credit in credits.items():
+                credit_credit_to_nomis(credit_id, credit, credit_updates)
+        self.assertEqual(mock_create_transaction.call_count, 2)
+        self.assertEqual(credit_updates.progress['failed'], 4)
+        self.assertFalse(nomis_circuit_breaker.allow_request())
+
+        # after the reset timeout, one trial call is let through and closes the circuit when it succeeds
+        caches['nomis_circuit'].set(nomis_circuit_breaker.opened_key, time.time() - 60)
+        mock_create_transaction.reset_mock()
+
+        def trial_create_transaction(**kwargs):
+            # other calls are not let through while the trial is in progress
+            self.assertFalse(nomis_circuit_breaker.allow_request())
+            return {'id': '1-1'}
+
+        mock_create_transaction.side_effect = trial_create_transaction
+        credit_credit_to_nomis(1, credits[1], credit_updates)
+        self.assertTrue(nomis_circuit_breaker.allow_request())
+        mock_create_transaction.side_effect = None
+        mock_create_transaction.return_value = {'id': '1-1'}
+        for credit_id, credit in credits.items():
+            credit_credit_to_nomis(credit_id, credit, credit_updates)
+        self.assertEqual(mock_create_transaction.call_count, 5)
+
+    @mock.patch('cashbook.tasks.send_credited_confirmations', mock.Mock())
+    @mock.patch('cashbook.tasks.get_api_session_with_session')
+    @mock.patch('cashbook.tasks.nomis.create_transaction', return_value={'id': '3-1'})
+    def test_interrupted_crediting_resumes_from_checkpoint(self, mock_create_transaction, mock_get_api_session):
+        credits = {credit_id: dict(CREDIT_1, id=credit_id) for credit_id in range(1, 5)}
+        # crediting was interrupted after credits 1 and 2 were sent to NOMIS, but only 1 was written to the API
+        checkpoint = CreditingCheckpoint(list(credits))
+        checkpoint.record_transacted(1, 'credited', '1-1')
+        checkpoint.record_transacted(2, 'credited', '2-1')
+        checkpoint.record_written([1])
+        checkpoint.record_transacted(4, 'manual')
+        checkpoint.file.write('{"id": 3, "outc')
+        checkpoint.file.close()
+
+        credit_selected_credits_to_nomis(
+            user=None, user_session={},
+            selected_credit_ids=list(credits), credits=credits,
+        )
+
+        mock_create_transaction.assert_called_once()
+        self.assertEqual(mock_create_transaction.call_args.kwargs['record_id'], '3')
+        api_session = mock_get_api_session.return_value
+        api_session.post.assert_has_calls([
+            mock.call('credits/actions/setmanual/', json={'credit_ids': [4]}),
+            mock.call('credits/actions/credit/', json=[
+                {'id': 2, 'credited': True, 'nomis_transaction_id': '2-1'},
+                {'id': 3, 'credited': True, 'nomis_transaction_id': '3-1'},
+            ]),
+        ])
+        self.assertFalse(os.path.exists(checkpoint.path))
+
+    @override_settings(NOMIS_CIRCUIT_BREAKER_FAILURE_THRESHOLD=2)
+    def test_nomis_circuit_breaker_failure_counted_after_concurrent_success(self):
+        cache = caches['nomis_circuit']
+        nomis_circuit_breaker.record_failure()
+        self.assertEqual(cache.get(nomis_circuit_breaker.failures_key), 1)
+
+        incr = cache.incr
+
+        def incr_after_success(*args, **kwargs):
+            # another spooler records a success just before the failure is counted
+            nomis_circuit_breaker.record_success()
+            return incr(*args, **kwargs)
+
+        with mock.patch.object(cache, 'incr', side_effect=incr_after_success):
+            nomis_circuit_breaker.record_failure()
+        self.assertEqual(cache.get(nomis_circuit_breaker.failures_key), 1)
+        self.assertTrue(nomis_circuit_breaker.allow_request())
+
+    @override_settings(PRISONER_CAPPING_ENABLED=True)
+    @mock.patch('cashbook.tasks.check_prisoner_balance_is_below_cap')
+    @mock.patch('cashbook.tasks.send_credited_confirmations', mock.Mock())
+    @mock.patch('cashbook.tasks.get_api_session_with_session', mock.Mock())
+    def test_balance_checked_only_for_credited_prisoners(self, mock_check_balance):
+        credits = {
+            1: CREDIT_1,
+            2: CREDIT_2,
+            3: dict(CREDIT_2, id=3, prisoner_number='A1234ZZ'),
+        }
+
+        def credit_credit_to_nomis(credit_id, credit, credit_updates):
+            if credit_id == 2:
+                credit_updates.add_set_manual(credit_id)
+            else:
+                credit_updates.add_credited(credit_id, credit)
+
+        with mock.patch('cashbook.tasks.credit_credit_to_nomis', side_effect=credit_credit_to_nomis):
+            # credit 3 is on the page but not selected
+            credit_selected_credits_to_nomis(user=None, user_session={}, selected_credit_ids=[1, 2], credits=credits)
+            mock_check_balance.assert_called_once_with('BXI', 'A1234BC')
+
+            # prisoner was checked recently
+            credit_selected_credits_to_nomis(user=None, user_session={}, selected_credit_ids=[1], credits=credits)
+            self.assertEqual(mock_check_balance.call_count, 1)
+
+    @override_settings(PRISONER_CAPPING_ENABLED=True)
+    @mock.patch('cashbook.tasks.nomis.get_account_balances')
+    @mock.patch('cashbook.tasks.send_credited_confirmations', mock.Mock())
+    @mock.patch('cashbook.tasks.get_api_session_with_session', mock.Mock())
+    def test_balance_checked_again_after_failed_lookup(self, mock_get_account_balances):
+        def credit_credit_to_nomis(credit_id, credit, credit_updates):
+            credit_updates.add_credited(credit_id, credit)
+
+        with mock.patch('cashbook.tasks.credit_credit_to_nomis', side_effect=credit_credit_to_nomis):
+            mock_get_account_balances.side_effect = requests.ConnectionError
+            with silence_logger():
+                credit_selected_credits_to_nomis(
+                    user=None, user_session={}, selected_credit_ids=[1], credits={1: CREDIT_1},
+                )
+            mock_get_account_balances.side_effect = None
+            mock_get_account_balances.return_value = {'cash': 0, 'spends': 0, 'savings': 0}
+            credit_selected_credits_to_nomis(user=None, user_session={}, selected_credit_ids=[1], credits={1: CREDIT_1})
+            # prisoner was checked recently
+            credit_selected_credits_to_nomis(user=None, user_session={}, selected_credit_ids=[1], credits={1: CREDIT_1})
+        self.assertEqual(mock_get_account_balances.call_count, 2)
+
+    @override_settings(CREDIT_UPDATES_BATCH_SIZE=3, CREDIT_UPDATES_INTERVAL=60)
+    @mock.patch('cashbook.tasks.send_credited_confirmations')
+    @mock.patch('cashbook.tasks.get_api_session_with_session')
+    def test_credit_updates_written_in_bulk(self, mock_get_api_session, mock_send_credited_confirmations):
+        api_session = mock_get_api_session.return_value
+        with CreditUpdates(user=None, user_session={}) as credit_updates:
+            credit_updates.add_credited(1, CREDIT_1, 'A1234BC-1')
+            credit_updates.add_set_manual(3)
+            self.assertEqual(api_session.post.call_count, 0)
+            credit_updates.add_credited(2, CREDIT_2)
+            # written once 3 updates have accumulated
+            api_session.post.assert_has_calls([
+                mock.call('credits/actions/setmanual/', json={'credit_ids': [3]}),
+                mock.call('credits/actions/credit/', json=[
+                    {'id': 1, 'credited': True, 'nomis_transaction_id': 'A1234BC-1'},
+                    {'id': 2, 'credited': True},
+                ]),
+            ])
+            # senders are notified in one task
+            mock_send_credited_confirmations.assert_called_once_with(credits={1: CREDIT_1, 2: CREDIT_2})
+            credit_updates.add_set_manual(4)
+        # remaining updates written when closed
+        self.assertEqual(api_session.post.call_count, 3)
+        api_session.post.assert_called_with('credits/actions/setmanual/', json={'credit_ids': [4]})
+        self.assertEqual(mock_send_credited_confirmations.call_count, 1)
+
+    @mock.patch('cashbook.tasks.send_credited_confirmations')
+    @mock.patch('cashbook.tasks.get_api_session_with_session')
+    def test_credit_updates_retried_then_written_individually(
+        self, mock_get_api_session, mock_send_credited_confirmations,
+    ):
+        api_session = mock_get_api_session.return_value
+        rejected = HttpClientError(response=mock.Mock(status_code=400))
+        unavailable = HttpServerError(response=mock.Mock(status_code=503))
+
+        def post(path, json):
+            if path == 'credits/actions/setmanual/':
+                # temporarily unavailable
+                if api_session.post.call_count == 1:
+                    raise unavailable
+            elif any(credit_update['id'] == 2 for credit_update in json):
+                raise rejected
+
+        api_session.post.side_effect = post
+        credit_updates = CreditUpdates(user=None, user_session={})
+        with credit_updates:
+            credit_updates.add_set_manual(4)
+            credit_updates.add_credited(1, CREDIT_1)
+            credit_updates.add_credited(2, CREDIT_2)
+            credit_updates.add_credited(3, dict(CREDIT_1, id=3))
+
+        api_session.post.assert_has_calls([
+            mock.call('credits/actions/setmanual/', json={'credit_ids': [4]}),
+            mock.call('credits/actions/setmanual/', json={'credit_ids': [4]}),
+            # rejected bulk write is not retried
+            mock.call('credits/actions/credit/', json=[
+                {'id': 1, 'credited': True}, {'id': 2, 'credited': True}, {'id': 3, 'credited': True},
+            ]),
+            mock.call('credits/actions/credit/', json=[{'id': 1, 'credited': True}]),
+            mock.call('credits/actions/credit/', json=[{'id': 2, 'credited': True}]),
+            mock.call('credits/actions/credit/', json=[{'id': 3, 'credited': True}]),
+        ])
+        self.assertEqual(api_session.post.call_count, 6)
+        self.assertDictEqual(credit_updates.progress, {'done': 2, 'failed': 1, 'manual': 1})
+        mock_send_credited_confirmations.assert_called_once_with(credits={1: CREDIT_1, 3: dict(CREDIT_1, id=3)})
+
+    @mock.patch('cashbook.tasks.send_credited_confirmations', mock.Mock())
+    @mock.patch('cashbook.tasks.get_api_session_with_session')
+    @mock.patch('cashbook.tasks.nomis.create_transaction', return_value={})
+    def test_checkpoint_kept_while_credits_not_updated_in_api(self, _, mock_get_api_session):
+        mock_get_api_session.return_value.post.side_effect = HttpServerError(response=mock.Mock(status_code=503))
+        credits = {1: CREDIT_1}
+        with silence_logger():
+            credit_selected_credits_to_nomis(user=None, user_session={}, selected_credit_ids=[1], credits=credits)
+
+        checkpoint = CreditingCheckpoint([1])
+        self.assertTrue(os.path.exists(checkpoint.path))
+        self.assertSetEqual(checkpoint.unwritten_ids, {1})
+        checkpoint.remove()
+
+    def test_expired_checkpoints_removed(self):
+        expired_checkpoint = CreditingCheckpoint([1])
+        expired_checkpoint.record_transacted(1, 'credited', '1-1')
+        expired_checkpoint.close()
+        recent_checkpoint = CreditingCheckpoint([2])
+        recent_checkpoint.record_transacted(2, 'credited', '2-1')
+        recent_checkpoint.close()
+        expired = time.time() - settings.CREDITING_CHECKPOINT_MAX_AGE - 60
+        os.utime(expired_checkpoint.path, (expired, expired))
+
+        with silence_logger():
+            checkpoint = CreditingCheckpoint([3])
+        self.assertFalse(os.path.exists(expired_checkpoint.path))
+        self.assertTrue(os.path.exists(recent_checkpoint.path))
+        self.assertDictEqual(checkpoint.transacted, {})
+
+    def test_credited_confirmations_sent_once(self):
+        with NotifyMock() as rsps:
+            send_credited_confirmations(credits={1: PendingCredit(**CREDIT_1), 2: PendingCredit(**CREDIT_2)})
+            send_credited_confirmations(credits={1: PendingCredit(**CREDIT_1)})
+            self.assertListEqual(
+                sorted(data['reference'] for data in rsps.send_email_request_data),
+                ['credited-1', 'credited-2'],
+            )
+
+    def test_credited_confirmations_sent_again_if_interrupted(self):
+        with mock.patch('cashbook.tasks.NotifyClient.shared_client') as mock_client:
+            # the spooler stops while sending an email
+            mock_client.return_value.send_email.side_effect = SystemExit
+            with self.assertRaises(SystemExit):
+                send_credited_confirmations(credits={1: PendingCredit(**CREDIT_1)})
+
+        with NotifyMock() as rsps:
+            send_credited_confirmations(credits={1: PendingCredit(**CREDIT_1)})
+            self.assertListEqual([data['reference'] for data in rsps.send_email_request_data], ['credited-1'])
+
     @mock.patch(
-        'cashbook.views.nomis.get_location',
+        'mtp_cashbook.utils.nomis.get_location',
         return_value={
             'nomis_id': 'LEI',
             'name': 'LEEDS (HMP)',
@@ -599,19 +1534,11 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
     )
     def test_manual_credits_submit(self, _):
         with responses.RequestsMock() as rsps:
-            # get new credits
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
-                json=wrap_response_data(),
-                status=200,
-                match_querystring=True,
-            )
-            # get manual credits
+            # get submitted manual credit
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
-                json=wrap_response_data(CREDIT_1, CREDIT_2),
+                api_url('/credits/?status=credit_pending&resolution=manual&pk=1&offset=0&limit=100'),
+                json=wrap_response_data(dict(CREDIT_1, resolution='manual')),
                 status=200,
                 match_querystring=True,
             )
@@ -629,19 +1556,51 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 json=wrap_response_data(),
                 status=200,
             )
-            # get new credits
+            # get new and manual credits
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                json=wrap_response_data(dict(CREDIT_2, resolution='manual')),
+                status=200,
+                match_querystring=True,
+            )
+
+            self.login()
+            response = self.client.post(
+                self.url,
+                data={'submit_manual_1': ''},
+                follow=True
+            )
+            self.assertEqual(
+                json.loads(rsps.calls[1].request.body.decode('utf-8')),
+                [{'id': 1, 'credited': True}]
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, '1 credit manually input by you into NOMIS')
+            self.assertEqual(len(mail.outbox), 0)
+
+    @mock.patch(
+        'mtp_cashbook.utils.nomis.get_location',
+        return_value={
+            'nomis_id': 'LEI',
+            'name': 'LEEDS (HMP)',
+        },
+    )
+    def test_manual_credits_submit_unavailable_credit(self, _):
+        with responses.RequestsMock() as rsps:
+            # get submitted manual credit
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
+                api_url('/credits/?status=credit_pending&resolution=manual&pk=1&offset=0&limit=100'),
                 json=wrap_response_data(),
                 status=200,
                 match_querystring=True,
             )
-            # get manual credits
+            # get new and manual credits
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
-                json=wrap_response_data(CREDIT_2),
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                json=wrap_response_data(CREDIT_1, dict(CREDIT_2, resolution='manual')),
                 status=200,
                 match_querystring=True,
             )
@@ -652,17 +1611,188 @@ class NewCreditsViewTestCase(MTPBaseTestCase):
                 data={'submit_manual_1': ''},
                 follow=True
             )
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'That credit cannot be manually credited')
+
+    def test_manual_credits_submit_selected(self):
+        with responses.RequestsMock() as rsps:
+            # get selected manual credits
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?status=credit_pending&resolution=manual&pk=1&pk=2&offset=0&limit=100'),
+                json=wrap_response_data(dict(CREDIT_1, resolution='manual'), dict(CREDIT_2, resolution='manual')),
+                status=200,
+                match_querystring=True,
+            )
+            # credit credits to API
+            rsps.add(
+                rsps.POST,
+                api_url('/credits/actions/credit/'),
+                status=204,
+            )
+
+            self.login()
+            response = self.client.post(
+                self.url + '?manually_credited=3',
+                data={'submit_manual_selected': 'override', 'selected_credits': [1, 2]},
+            )
+            self.assertRedirects(response, self.url, fetch_redirect_response=False)
             self.assertEqual(
-                json.loads(rsps.calls[2].request.body.decode('utf-8')),
-                [{'id': 1, 'credited': True}]
+                json.loads(rsps.calls[1].request.body.decode('utf-8')),
+                [{'id': 1, 'credited': True}, {'id': 2, 'credited': True}]
             )
-            self.assertEqual(response.status_code, 200)
-            self.assertContains(response, '1 credit manually input by you into NOMIS')
-            self.assertEqual(len(mail.outbox), 0)
+
+    def test_manual_credits_submit_none_selected(self):
+        with responses.RequestsMock() as rsps:
+            # get new and manual credits
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                json=wrap_response_data(dict(CREDIT_1, resolution='manual')),
+                status=200,
+                match_querystring=True,
+            )
+
+            self.login()
+            response = self.client.post(self.url, data={'submit_manual_selected': 'override'})
+        self.assertContains(response, 'Only click ‘Done’ when you’ve selected credits')
+
+    def test_manual_credits_submit_in_place(self):
+        with responses.RequestsMock() as rsps:
+            # get submitted manual credit
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?status=credit_pending&resolution=manual&pk=1&offset=0&limit=100'),
+                json=wrap_response_data(dict(CREDIT_1, resolution='manual')),
+                status=200,
+                match_querystring=True,
+            )
+            # credit credit to API
+            rsps.add(
+                rsps.POST,
+                api_url('/credits/actions/credit/'),
+                status=204,
+            )
+            # count remaining manual credits
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?status=credit_pending&resolution=manual&limit=1'),
+                json={'count': 4, 'results': [dict(CREDIT_2, resolution='manual')]},
+                status=200,
+                match_querystring=True,
+            )
+
+            self.login()
+            response = self.client.post(
+                reverse('manual-credits') + '?manually_credited=2',
+                data={'submit_manual_1': 'override'},
+            )
+        self.assertEqual(response.status_code, 200)
+        response = response.json()
+        self.assertListEqual(response['credited'], [1])
+        self.assertEqual(response['manual_credits'], 4)
+        self.assertEqual(response['manually_credited'], 3)
+        self.assertIn('data-credit-id="1"', response['rows'])
+        self.assertIn('£52.00 to John Smith (A1234BC) has been marked as entered into NOMIS', response['rows'])
+
+    def test_manual_credits_submit_in_place_unavailable_credit(self):
+        with responses.RequestsMock() as rsps:
+            # get submitted manual credit
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?status=credit_pending&resolution=manual&pk=1&offset=0&limit=100'),
+                json=wrap_response_data(),
+                status=200,
+                match_querystring=True,
+            )
+
+            self.login()
+            response = self.client.post(reverse('manual-credits'), data={'submit_manual_1': 'override'})
+        self.assertEqual(response.status_code, 400)
+        self.assertListEqual(response.json()['errors'], ['That credit cannot be manually credited'])
+
+    @override_settings(NOMIS_LOCATION_LOOKUP_TIMEOUT=0.2)
+    def test_manual_credits_display_slow_locations(self):
+        slow_lookup_released = threading.Event()
+
+        def get_location(prisoner_number, **kwargs):
+            if prisoner_number == CREDIT_2['prisoner_number']:
+                slow_lookup_released.wait(timeout=5)
+            return {
+                'nomis_id': 'LEI',
+                'name': 'LEEDS (HMP)',
+            }
+
+        with responses.RequestsMock() as rsps, \
+                mock.patch('mtp_cashbook.utils.nomis.get_location', side_effect=get_location) as mock_get_location:
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/batches/'),
+                json=wrap_response_data(),
+                status=200,
+            )
+            # get new and manual credits
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                json=wrap_response_data(
+                    dict(CREDIT_1, resolution='manual'),
+                    dict(CREDIT_2, resolution='manual'),
+                    dict(CREDIT_1, id=3, resolution='manual'),
+                ),
+                status=200,
+                match_querystring=True,
+            )
+
+            self.login()
+            try:
+                response = self.client.get(self.url)
+            finally:
+                slow_lookup_released.set()
+        self.assertEqual(mock_get_location.call_count, 2, msg='Each prisoner should be looked up once')
+        self.assertContains(response, 'Prisoner transferred to LEEDS (HMP)', count=2)
+        self.assertContains(response, 'Prisoner left this prison', count=1)
+
+    @mock.patch(
+        'mtp_cashbook.utils.nomis.get_location',
+        return_value={
+            'nomis_id': 'LEI',
+            'name': 'LEEDS (HMP)',
+        },
+    )
+    def test_manual_credit_locations_cached(self, mock_get_location):
+        self.login()
+        for _ in range(2):
+            with responses.RequestsMock() as rsps:
+                rsps.add(
+                    rsps.GET,
+                    api_url('/credits/batches/'),
+                    json=wrap_response_data(),
+                    status=200,
+                )
+                # get new and manual credits
+                rsps.add(
+                    rsps.GET,
+                    api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                    json=wrap_response_data(
+                        dict(CREDIT_1, resolution='manual'),
+                        dict(CREDIT_2, resolution='manual'),
+                    ),
+                    status=200,
+                    match_querystring=True,
+                )
+                response = self.client.get(self.url)
+            self.assertContains(response, 'Prisoner transferred to LEEDS (HMP)', count=2)
+        self.assertEqual(mock_get_location.call_count, 2)
+
+        invalidate_prisoner_location(CREDIT_1['prisoner_number'])
+        self.assertEqual(get_prisoner_location(CREDIT_1['prisoner_number'])['nomis_id'], 'LEI')
+        self.assertEqual(get_prisoner_location(CREDIT_2['prisoner_number'])['nomis_id'], 'LEI')
+        self.assertEqual(mock_get_location.call_count, 3)
 
 
 @mock.patch(
-    'cashbook.views.nomis.get_location',
+    'mtp_cashbook.utils.nomis.get_location',
     mock.Mock(
         return_value={
             'nomis_id': 'LEI',
@@ -735,6 +1865,101 @@ class ProcessingCreditsViewTestCase(MTPBaseTestCase):
             response = self.client.get(reverse('processing-credits'), follow=True)
             self.assertContains(response, '50%')
 
+    def test_processing_credits_displays_published_progress(self):
+        user = mock.MagicMock(pk=100)
+        progress_keys = start_crediting_progress(user, [1, 2], 2)
+        publish_crediting_progress(progress_keys[0], done=1, failed=0, manual=0)
+        with responses.RequestsMock() as rsps:
+            # get active batches; progress of credits is not loaded from the api
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/batches/'),
+                json=wrap_response_data(PROCESSING_BATCH),
+                status=200,
+            )
+
+            self.login()
+            response = self.client.get(reverse('processing-credits'), follow=True)
+            self.assertContains(response, '50%')
+
+        self.assertEqual(get_crediting_progress(user, [1, 2]), {'done': 1, 'failed': 0, 'manual': 0, 'total': 2})
+        self.assertIsNone(get_crediting_progress(user, [1, 3]))
+
+    def test_processing_credits_progress_responds_with_published_progress(self):
+        progress_keys = start_crediting_progress(mock.MagicMock(pk=100), [1, 2], 1)
+        publish_crediting_progress(progress_keys[0], done=1, failed=0, manual=0)
+        with responses.RequestsMock() as rsps:
+            # get active batches
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/batches/'),
+                json=wrap_response_data(PROCESSING_BATCH),
+                status=200,
+            )
+
+            self.login()
+            response = self.client.get(reverse('processing-credits-progress'))
+
+        self.assertDictEqual(response.json(), {
+            'done': 1, 'failed': 0, 'manual': 0, 'total': 2,
+            'percentage': 50, 'published': True,
+        })
+
+        # the batch is not checked again until CREDITING_BATCH_CHECK_INTERVAL has passed
+        with responses.RequestsMock():
+            response = self.client.get(reverse('processing-credits-progress'))
+        self.assertEqual(response.json()['percentage'], 50)
+
+        # but it is as soon as crediting tasks have finished with every credit
+        publish_crediting_progress(progress_keys[0], done=1, failed=1, manual=0)
+        with responses.RequestsMock() as rsps:
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/batches/'),
+                json=wrap_response_data(EXPIRED_PROCESSING_BATCH),
+                status=200,
+            )
+            response = self.client.get(reverse('processing-credits-progress'))
+        self.assertDictEqual(response.json(), {'redirect': reverse('new-credits')})
+
+    def test_processing_credits_progress_falls_back_to_api(self):
+        with responses.RequestsMock() as rsps:
+            # get active batches
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/batches/'),
+                json=wrap_response_data(PROCESSING_BATCH),
+                status=200,
+            )
+            # get incomplete credits, only once as progress is not published
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/?resolution=pending&pk=1&pk=2'),
+                json=wrap_response_data(CREDIT_2),
+                status=200,
+                match_querystring=True,
+            )
+
+            self.login()
+            response = self.client.get(reverse('processing-credits-progress'))
+
+        self.assertDictEqual(response.json(), {'total': 2, 'percentage': 50, 'published': False})
+
+    def test_processing_credits_progress_redirects_for_expired_batch(self):
+        with responses.RequestsMock() as rsps:
+            # get active batches
+            rsps.add(
+                rsps.GET,
+                api_url('/credits/batches/'),
+                json=wrap_response_data(EXPIRED_PROCESSING_BATCH),
+                status=200,
+            )
+
+            self.login()
+            response = self.client.get(reverse('processing-credits-progress'))
+
+        self.assertDictEqual(response.json(), {'redirect': reverse('new-credits')})
+
     def test_processing_credits_displays_continue_when_done(self):
         with responses.RequestsMock() as rsps:
             # get active batches
@@ -794,19 +2019,11 @@ class ProcessingCreditsViewTestCase(MTPBaseTestCase):
                 api_url('/credits/batches/%s/' % PROCESSING_BATCH['id']),
                 status=200,
             )
-            # get new credits
-            rsps.add(
-                rsps.GET,
-                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending&resolution=pending'),
-                json=wrap_response_data(),
-                status=200,
-                match_querystring=True,
-            )
-            # get manual credits
+            # get new and manual credits
             rsps.add(
                 rsps.GET,
-                api_url('/credits/?resolution=manual&status=credit_pending&offset=0&limit=100&ordering=-received_at'),
-                json=wrap_response_data(CREDIT_2),
+                api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                json=wrap_response_data(dict(CREDIT_2, resolution='manual')),
                 status=200,
                 match_querystring=True,
             )
@@ -815,6 +2032,55 @@ class ProcessingCreditsViewTestCase(MTPBaseTestCase):
             response = self.client.get(self.url, follow=True)
             self.assertRedirects(response, reverse('new-credits'))
 
+    def test_new_credits_reports_completed_batch_once(self):
+        completed_batch = dict(PROCESSING_BATCH, credits=[1])
+        with responses.RequestsMock() as rsps:
+            # batch is still listed on the second visit as it is deleted off the response path
+            for _ in range(2):
+                # get active batches
+                rsps.add(
+                    rsps.GET,
+                    api_url('/credits/batches/'),
+                    json=wrap_response_data(completed_batch),
+                    status=200,
+                )
+                # get incomplete credits
+                rsps.add(
+                    rsps.GET,
+                    api_url('/credits/?resolution=pending&pk=1'),
+                    json=wrap_response_data(),
+                    status=200,
+                    match_querystring=True,
+                )
+                # get complete credits
+                rsps.add(
+                    rsps.GET,
+                    api_url('/credits/?resolution=credited&pk=1'),
+                    json=wrap_response_data(CREDIT_1),
+                    status=200,
+                    match_querystring=True,
+                )
+                # delete completed batch
+                rsps.add(
+                    rsps.DELETE,
+                    api_url('/credits/batches/%s/' % completed_batch['id']),
+                    status=200,
+                )
+                # get new and manual credits
+                rsps.add(
+                    rsps.GET,
+                    api_url('/credits/?ordering=-received_at&offset=0&limit=100&status=credit_pending'),
+                    json=wrap_response_data(),
+                    status=200,
+                    match_querystring=True,
+                )
+
+            self.login()
+            response = self.client.get(reverse('new-credits'))
+            self.assertContains(response, '1 credit sent to NOMIS')
+            response = self.client.get(reverse('new-credits'))
+            self.assertNotContains(response, 'sent to NOMIS')
+
 
 class ProcessedCreditsListViewTestCase(MTPBaseTestCase):
 
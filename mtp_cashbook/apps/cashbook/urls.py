@@ -2,7 +2,8 @@ from django.urls import re_path
 from django.views.generic import RedirectView
 
 from .views import (
-    NewCreditsView, ProcessingCreditsView,
+    NewCreditsView, NewCreditsWindowView, NewCreditsChangesView, ManualCreditsView,
+    ProcessingCreditsView, ProcessingCreditsProgressView,
     ProcessedCreditsListView, ProcessedCreditsDetailView,
     SearchView,
     CashbookFAQView,
@@ -11,6 +12,9 @@ from .views import (
 
 urlpatterns = [
     re_path(r'^new/$', NewCreditsView.as_view(), name='new-credits'),
+    re_path(r'^new/window/$', NewCreditsWindowView.as_view(), name='new-credits-window'),
+    re_path(r'^new/changes/$', NewCreditsChangesView.as_view(), name='new-credits-changes'),
+    re_path(r'^new/manual/$', ManualCreditsView.as_view(), name='manual-credits'),
 
     re_path(r'^processed/$', ProcessedCreditsListView.as_view(), name='processed-credits-list'),
     re_path(
@@ -19,6 +23,7 @@ urlpatterns = [
         name='processed-credits-detail',
     ),
     re_path(r'^processing/$', ProcessingCreditsView.as_view(), name='processing-credits'),
+    re_path(r'^processing/progress/$', ProcessingCreditsProgressView.as_view(), name='processing-credits-progress'),
 
     re_path(r'^search/$', SearchView.as_view(), name='search'),
     re_path(r'^all/$', RedirectView.as_view(pattern_name='search', permanent=True)),
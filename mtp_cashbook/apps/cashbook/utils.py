@@ -0,0 +1,495 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import datetime
+import hashlib
+import heapq
+import json
+import logging
+import re
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.utils import timezone
+from django.utils.functional import cached_property
+from requests.exceptions import RequestException
+
+from mtp_cashbook.utils import LazyDateField, get_prisoner_location, parse_date_value
+
+logger = logging.getLogger('mtp')
+
+
+def retrieve_all_pages_concurrently(session, path, **params):
+    """
+    Loads all pages of a list from the API like `mtp_common.api.retrieve_all_pages_for_path`,
+    but once the first page reveals the total count, the remaining pages are requested
+    concurrently (at most API_CONCURRENT_PAGE_REQUESTS at a time) and reassembled in order
+    :param session: Requests Session object
+    :param path: URL path
+    :param params: additional URL params
+    """
+    page_size = settings.REQUEST_PAGE_SIZE
+
+    def retrieve_page(offset):
+        response = session.get(
+            path,
+            params=dict(limit=page_size, offset=offset, **params)
+        )
+        return response.json()
+
+    content = retrieve_page(0)
+    count = content.get('count', 0)
+    loaded_results = content.get('results', [])
+    if len(loaded_results) >= count:
+        return loaded_results
+
+    offsets = range(page_size, count, page_size)
+    with ThreadPoolExecutor(
+        max_workers=min(settings.API_CONCURRENT_PAGE_REQUESTS, len(offsets)),
+        thread_name_prefix='api-pages',
+    ) as executor:
+        for content in executor.map(retrieve_page, offsets):
+            loaded_results += content.get('results', [])
+    return loaded_results
+
+
+def get_user_prison_ids(user):
+    """
+    :return: sorted NOMIS ids of the prisons a user has access to
+    """
+    return sorted({prison['nomis_id'] for prison in user.user_data.get('prisons') or []})
+
+
+def get_ordering_key(ordering):
+    """
+    Sorting key and direction matching an API `ordering` parameter for a single field;
+    like the API's database, nulls sort as the largest values
+    """
+    field = ordering.lstrip('-')
+
+    def key(item):
+        value = item.get(field)
+        if value is None:
+            return (True,)
+        if field.endswith('_at'):
+            value = parse_date_value(value)
+        return False, value
+
+    return key, ordering.startswith('-')
+
+
+def retrieve_all_pages_by_prison(session, path, prisons, ordering=None, **params):
+    """
+    Loads all pages of a list from the API like `retrieve_all_pages_concurrently`,
+    but when several prisons are given, each prison's list is loaded concurrently
+    (at most API_CONCURRENT_PRISON_REQUESTS at a time) and the lists are merged by `ordering`
+    so that one large prison's pages do not hold up the others
+    :param session: Requests Session object
+    :param path: URL path
+    :param prisons: NOMIS ids of prisons to load separately
+    :param ordering: API ordering by a single field
+    :param params: additional URL params
+    """
+    if ordering:
+        params['ordering'] = ordering
+    if len(prisons) < 2:
+        return retrieve_all_pages_concurrently(session, path, **params)
+
+    def retrieve_prison(prison):
+        return retrieve_all_pages_concurrently(session, path, prison=prison, **params)
+
+    with ThreadPoolExecutor(
+        max_workers=min(settings.API_CONCURRENT_PRISON_REQUESTS, len(prisons)),
+        thread_name_prefix='api-prisons',
+    ) as executor:
+        prison_results = list(executor.map(retrieve_prison, prisons))
+    if not ordering:
+        return [item for results in prison_results for item in results]
+    key, reverse = get_ordering_key(ordering)
+    return list(heapq.merge(*prison_results, key=key, reverse=reverse))
+
+
+class CreditSet:
+    """
+    Credits loaded from the API along with their sort keys for each of `sortable_fields`
+    so that they can be re-ordered in memory
+    """
+    sortable_fields = ('received_at', 'amount', 'prisoner_number')
+
+    def __init__(self, credits):
+        self.credits = credits
+        self.sort_keys = {
+            field: list(map(get_ordering_key(field)[0], credits))
+            for field in self.sortable_fields
+        }
+
+    def ordered(self, ordering):
+        sort_keys = self.sort_keys[ordering.lstrip('-')]
+        # sorting is stable so credits ordered as loaded from the API are returned unchanged
+        indices = sorted(range(len(self.credits)), key=sort_keys.__getitem__, reverse=ordering.startswith('-'))
+        return [self.credits[index] for index in indices]
+
+
+def _credit_set_version_key(user):
+    return f'credit-set-version-{user.pk}'
+
+
+def get_credit_set_token(token=None):
+    """
+    :return: `token` if it can identify a credit set loaded for a page, otherwise a new one
+    """
+    if token and re.fullmatch(r'[0-9a-f]{32}', token):
+        return token
+    return uuid.uuid4().hex
+
+
+def get_credit_set_cache_key(user, token, path, params):
+    version = caches['credit_sets'].get_or_set(
+        _credit_set_version_key(user), lambda: uuid.uuid4().hex, timeout=None
+    )
+    params = json.dumps(dict(params, path=path), sort_keys=True, default=str)
+    return f'credit-set-{user.pk}-{version}-{token}-{hashlib.sha256(params.encode()).hexdigest()}'
+
+
+def invalidate_credit_sets(user):
+    """
+    Forgets all credit sets cached for a user, e.g. once they have credited some
+    """
+    caches['credit_sets'].delete(_credit_set_version_key(user))
+
+
+def retrieve_credit_set(session, user, path, ordering, token=None, /, **params):
+    """
+    Loads all credits matching `params` like `retrieve_all_pages_by_prison` for the user's prisons.
+    Given a `token` identifying the page they are loaded for, they are kept in a short-lived cache
+    shared by all uWSGI workers so that re-ordering that page (by one of `CreditSet.sortable_fields`)
+    re-sorts them in memory rather than loading them all again; without a token they are always loaded afresh
+    :param session: Requests Session object
+    :param user: the user the credits are loaded for
+    :param path: URL path
+    :param ordering: API ordering by a single field
+    :param token: identifies the page the credits are loaded for, see `get_credit_set_token`
+    :param params: additional URL params
+    :return: list of credits
+    """
+    prisons = get_user_prison_ids(user)
+    if not token or not ordering or ordering.lstrip('-') not in CreditSet.sortable_fields:
+        return retrieve_all_pages_by_prison(session, path, prisons, ordering=ordering, **params)
+
+    cache = caches['credit_sets']
+    cache_key = get_credit_set_cache_key(user, token, path, params)
+    credit_set = cache.get(cache_key)
+    if credit_set is None:
+        credit_set = CreditSet(retrieve_all_pages_by_prison(session, path, prisons, ordering=ordering, **params))
+        cache.set(cache_key, credit_set)
+    return credit_set.ordered(ordering)
+
+
+class PendingCredit:
+    """
+    Compact record of a credit awaiting crediting to NOMIS that keeps only the fields
+    used to display and credit it; dict-style access is supported for templates and tasks
+    """
+    fields = (
+        'id', 'prison', 'prisoner_number', 'prisoner_name', 'amount',
+        'sender_name', 'sender_email', 'short_payment_ref', 'intended_recipient',
+        'received_at', 'set_manual_at', 'resolution', 'reviewed', 'comments',
+        'owner', 'owner_name', 'new_location',
+    )
+    __slots__ = tuple(
+        f'_{field}' if field in ('received_at', 'set_manual_at') else field
+        for field in fields
+    )
+    received_at = LazyDateField()
+    set_manual_at = LazyDateField()
+
+    def __init__(self, **fields):
+        for field in self.fields:
+            setattr(self, field, fields.get(field))
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.id}>'
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+
+class PendingCredits:
+    """
+    Loads credits awaiting crediting to NOMIS for a user with a single sweep of the API (see `retrieve_credit_set`)
+    and splits them by resolution so that the new and manual credit forms can share it;
+    only given a `credit_set_token` can a sweep made for the same page be re-sorted instead
+    """
+    resolutions = ('pending', 'manual')
+
+    def __init__(self, session, user, ordering='-received_at', credit_set_token=None):
+        self.session = session
+        self.user = user
+        self.ordering = ordering
+        self.credit_set_token = credit_set_token
+
+    @cached_property
+    def credits_by_resolution(self):
+        credits_by_resolution = {resolution: [] for resolution in self.resolutions}
+        credits = retrieve_credit_set(
+            self.session, self.user, 'credits/', self.ordering, self.credit_set_token, status='credit_pending'
+        )
+        for credit in credits:
+            if credit.get('resolution') in credits_by_resolution:
+                credits_by_resolution[credit['resolution']].append(credit)
+        return credits_by_resolution
+
+    def get_credits(self, resolution):
+        return self.credits_by_resolution[resolution]
+
+
+def get_credit_ids_digest(credit_ids):
+    """
+    Identifies a set of credits so that selecting all of them
+    does not require every row to have been loaded into the page
+    """
+    credit_ids = ','.join(map(str, sorted(credit_ids)))
+    return hashlib.sha256(credit_ids.encode()).hexdigest()
+
+
+def save_credit_snapshot(user, credits):
+    """
+    Keeps the credits rendered to a user in a cache shared by all uWSGI workers
+    so that submitting the page does not require every pending credit to be loaded again
+    :param user: the user the credits were rendered to
+    :param credits: dict of PendingCredit keyed by id
+    :return: signed token referencing the snapshot
+    """
+    key = f'credit-snapshot-{user.pk}-{uuid.uuid4().hex}'
+    caches['credit_snapshots'].set(key, credits)
+    return signing.dumps(key, salt='cashbook.credit-snapshot')
+
+
+def _credit_snapshot_key(user, token):
+    if not token:
+        return None
+    try:
+        key = signing.loads(
+            token, salt='cashbook.credit-snapshot',
+            max_age=settings.CACHES['credit_snapshots']['TIMEOUT'],
+        )
+    except signing.BadSignature:
+        return None
+    if not key.startswith(f'credit-snapshot-{user.pk}-'):
+        return None
+    return key
+
+
+def load_credit_snapshot(user, token):
+    """
+    :return: dict of PendingCredit rendered to the user or None if the token is invalid or the snapshot has expired
+    """
+    key = _credit_snapshot_key(user, token)
+    if key is None:
+        return None
+    return caches['credit_snapshots'].get(key)
+
+
+def renew_credit_snapshot(user, token):
+    """
+    Extends the life of a snapshot that is still shown to the user without saving it again
+    :return: new signed token referencing the snapshot or None if the token is invalid or the snapshot has expired
+    """
+    key = _credit_snapshot_key(user, token)
+    if key is None or not caches['credit_snapshots'].touch(key):
+        return None
+    return signing.dumps(key, salt='cashbook.credit-snapshot')
+
+
+def _crediting_progress_key(user):
+    return f'crediting-progress-{user.pk}'
+
+
+def start_crediting_progress(user, credit_ids, chunk_count):
+    """
+    Records that a user's batch of credits is about to be credited to NOMIS in chunks
+    so that progress can be read from a cache shared by all uWSGI workers and spoolers
+    rather than by querying the API for every credit in the batch
+    :return: keys under which each chunk's crediting task publishes its progress
+    """
+    cache = caches['crediting_progress']
+    batch_key = f'{_crediting_progress_key(user)}-{uuid.uuid4().hex}'
+    chunk_keys = [f'{batch_key}-{index}' for index in range(chunk_count)]
+    cache.set_many({chunk_key: {'done': 0, 'failed': 0, 'manual': 0} for chunk_key in chunk_keys})
+    cache.set(_crediting_progress_key(user), {
+        'digest': get_credit_ids_digest(credit_ids),
+        'total': len(credit_ids),
+        'chunk_keys': chunk_keys,
+    })
+    return chunk_keys
+
+
+def publish_crediting_progress(chunk_key, done, failed, manual):
+    """
+    Publishes counts of credits in a chunk that have been credited (`done`), set as needing manual input
+    or that could not be credited (`failed`); each chunk is written only by its own crediting task
+    """
+    caches['crediting_progress'].set(chunk_key, {'done': done, 'failed': failed, 'manual': manual})
+
+
+def get_crediting_progress(user, credit_ids=None):
+    """
+    :param user: the user crediting the batch
+    :param credit_ids: ids of credits in the batch, if not given the batch the user last started crediting is assumed
+    :return: dict of `done`, `failed`, `manual` and `total` counts or None if progress was not recorded for the batch
+    """
+    cache = caches['crediting_progress']
+    batch = cache.get(_crediting_progress_key(user))
+    if not batch or (credit_ids is not None and batch['digest'] != get_credit_ids_digest(credit_ids)):
+        return None
+    chunks = cache.get_many(batch['chunk_keys'])
+    if len(chunks) != len(batch['chunk_keys']):
+        return None
+    progress = {'done': 0, 'failed': 0, 'manual': 0, 'total': batch['total']}
+    for chunk in chunks.values():
+        for count in ('done', 'failed', 'manual'):
+            progress[count] += chunk[count]
+    return progress
+
+
+def is_crediting_batch_check_due(user):
+    """
+    Progress published by crediting tasks is read without asking the API about the batch,
+    but it is still checked every CREDITING_BATCH_CHECK_INTERVAL seconds in case the batch has expired
+    :return: True if the API should be asked about the user's batch now
+    """
+    return caches['crediting_progress'].add(
+        f'{_crediting_progress_key(user)}-checked', True, timeout=settings.CREDITING_BATCH_CHECK_INTERVAL,
+    )
+
+
+class PendingCreditChanges:
+    """
+    Finds new credits added or resolved since a client-held watermark so that
+    the New credits page can be kept up-to-date without reloading every pending credit.
+    The watermark is a signed token holding the latest receipt time of credits already shown,
+    the ids of credits received at that moment and the time from which resolutions are reported;
+    changes are applied to the snapshot of credits shown on the page (see `save_credit_snapshot`).
+    """
+    salt = 'cashbook.new-credits-changes'
+    max_age = datetime.timedelta(days=1)
+    # resolutions are reported with some overlap to tolerate clock differences with the API,
+    # those already removed from the snapshot are ignored
+    overlap = datetime.timedelta(minutes=1)
+
+    def __init__(self, session, token, credits):
+        """
+        :param session: Requests Session object
+        :param token: watermark, see `make_token`
+        :param credits: dict of PendingCredit shown on the page keyed by id, in the page's ordering
+        """
+        self.session = session
+        watermark = signing.loads(token, salt=self.salt, max_age=self.max_age)
+        self.received_at = parse_date_value(watermark['received_at'])
+        self.seen = set(watermark['seen'])
+        self.since = parse_date_value(watermark['since'])
+        self.now = timezone.now()
+        self.credits = credits
+
+    @classmethod
+    def make_token(cls, credits, received_at=None, seen=(), since=None):
+        """
+        :param credits: iterable of PendingCredit already shown
+        :param received_at: previous watermark, kept if no credits were received later
+        :param seen: ids of credits received at the previous watermark
+        :param since: time from which resolutions should next be reported, defaults to now
+        """
+        credits = [credit for credit in credits if credit.received_at]
+        latest_received_at = max((credit.received_at for credit in credits), default=None)
+        if latest_received_at is None or (received_at and received_at > latest_received_at):
+            latest_received_at = received_at
+        seen = set(seen) if latest_received_at == received_at else set()
+        seen.update(credit.id for credit in credits if credit.received_at == latest_received_at)
+        return signing.dumps({
+            'received_at': latest_received_at and latest_received_at.isoformat(),
+            'seen': sorted(seen),
+            'since': (since or timezone.now()).isoformat(),
+        }, salt=cls.salt)
+
+    @cached_property
+    def resolved_ids(self):
+        credits = retrieve_all_pages_concurrently(
+            self.session, 'credits/',
+            log__action='credited', logged_at__gte=(self.since - self.overlap).isoformat(),
+        )
+        # credits not shown on the page, including those already reported, are not changes
+        return sorted(credit['id'] for credit in credits if credit['id'] in self.credits)
+
+    @cached_property
+    def added_credits(self):
+        filters = {'status': 'credit_pending', 'resolution': 'pending', 'ordering': 'received_at'}
+        if self.received_at:
+            filters['received_at__gte'] = self.received_at.isoformat()
+        credits = retrieve_all_pages_concurrently(self.session, 'credits/', **filters)
+        return [
+            PendingCredit(**credit)
+            for credit in credits
+            if credit['id'] not in self.seen and credit['id'] not in self.credits
+        ]
+
+    @property
+    def has_changes(self):
+        return bool(self.added_credits or self.resolved_ids)
+
+    def merged_credits(self, ordering):
+        """
+        :param ordering: the page's ordering by a single field
+        :return: dict of PendingCredit shown on the page once changes are merged, keyed by id in `ordering`
+        """
+        key, reverse = get_ordering_key(ordering)
+        resolved_ids = set(self.resolved_ids)
+        credits = [item for item in self.credits.items() if item[0] not in resolved_ids]
+        added_credits = sorted(
+            ((credit.id, credit) for credit in self.added_credits),
+            key=lambda item: key(item[1]), reverse=reverse,
+        )
+        return dict(heapq.merge(credits, added_credits, key=lambda item: key(item[1]), reverse=reverse))
+
+    @property
+    def next_token(self):
+        return self.make_token(self.added_credits, received_at=self.received_at, seen=self.seen, since=self.now)
+
+
+def get_prisoner_locations(prisoner_numbers):
+    """
+    Looks up the NOMIS locations of prisoners concurrently using a bounded pool of workers.
+    Lookups that fail or are still outstanding after NOMIS_LOCATION_LOOKUP_TIMEOUT seconds are omitted.
+    :param prisoner_numbers: iterable of prisoner numbers, duplicates are only looked up once
+    :return: dict of locations keyed by prisoner number
+    """
+    prisoner_numbers = set(prisoner_numbers)
+    if not prisoner_numbers:
+        return {}
+
+    executor = ThreadPoolExecutor(
+        max_workers=min(settings.NOMIS_LOCATION_LOOKUP_WORKERS, len(prisoner_numbers)),
+        thread_name_prefix='nomis-location',
+    )
+    futures = {
+        executor.submit(get_prisoner_location, prisoner_number): prisoner_number
+        for prisoner_number in prisoner_numbers
+    }
+    done, not_done = wait(futures, timeout=settings.NOMIS_LOCATION_LOOKUP_TIMEOUT)
+    # do not hold up the response waiting for stragglers
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    locations = {}
+    for future in done:
+        try:
+            locations[futures[future]] = future.result()
+        except RequestException:
+            pass
+    if not_done:
+        logger.warning('%(count)d NOMIS location lookups did not complete in time', {'count': len(not_done)})
+    return locations
@@ -1,22 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import logging
+from urllib.parse import urlencode
 
 from django.conf import settings
 from django.contrib import messages
+from django.core import signing
+from django.http import Http404, HttpResponseBadRequest, JsonResponse
 from django.shortcuts import redirect
+from django.template.loader import render_to_string
 from django.urls import reverse, reverse_lazy
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 from django.views.generic import FormView, TemplateView
 from mtp_common.analytics import genericised_pageview
 from mtp_common.auth import api_client
-from mtp_common import nomis
-from requests.exceptions import RequestException
 
 from cashbook.forms import (
     ProcessNewCreditsForm, ProcessManualCreditsForm,
     FilterProcessedCreditsListForm, FilterProcessedCreditsDetailForm,
     SearchForm, MANUALLY_CREDITED_LOG_LEVEL,
 )
+from cashbook.tasks import delete_credit_batch
+from cashbook.utils import (
+    PendingCreditChanges, PendingCredits,
+    get_credit_ids_digest, get_credit_set_token, get_crediting_progress, get_prisoner_locations,
+    invalidate_credit_sets, is_crediting_batch_check_due,
+    load_credit_snapshot, renew_credit_snapshot, save_credit_snapshot,
+)
 from feedback.views import GetHelpView, GetHelpSuccessView
 from mtp_cashbook.misc_views import BaseView
 from mtp_cashbook.utils import one_month_ago
@@ -67,6 +78,7 @@ class NewCreditsView(CashbookView, FormView):
     }
     template_name = 'cashbook/new_credits.html'
     success_url = reverse_lazy('new-credits')
+    reported_batch_session_key = 'reported_credit_batch'
 
     def get_form(self, form_class=None):
         """
@@ -79,33 +91,55 @@ class NewCreditsView(CashbookView, FormView):
             for name in form_class
         }
 
+    # identifies the credits loaded to render the page so that re-ordering it does not load them again,
+    # other requests always load credits afresh
+    credit_set_token = None
+
+    @cached_property
+    def pending_credits(self):
+        return PendingCredits(
+            api_client.get_api_session(self.request), self.request.user, self.ordering, self.credit_set_token,
+        )
+
     def get_form_kwargs(self):
         form_kwargs = super().get_form_kwargs()
         form_kwargs['request'] = self.request
         if 'ordering' in self.request.GET:
             form_kwargs['ordering'] = self.request.GET['ordering']
+        # new and manual credit forms share one sweep of pending credits
+        form_kwargs['pending_credits'] = self.pending_credits
         return form_kwargs
 
     def get(self, request, *args, **kwargs):
+        self.credit_set_token = get_credit_set_token(request.GET.get('credit_set'))
         session = api_client.get_api_session(self.request)
         batches = session.get('credits/batches/').json()
         if batches['count']:
+            # credits in the last batch have been or are being credited
+            invalidate_credit_sets(request.user)
             last_batch = batches['results'][0]
             credit_ids = last_batch['credits']
-            incomplete_credits = session.get(
-                'credits/', params={'resolution': 'pending', 'pk': credit_ids}
-            ).json()
-            if not last_batch['expired'] and incomplete_credits['count']:
-                return redirect('processing-credits')
-
-            credited_credits = session.get(
-                'credits/', params={'resolution': 'credited', 'pk': credit_ids}
-            ).json()
-            kwargs['credited_credits'] = credited_credits['count']
-            kwargs['failed_credits'] = incomplete_credits['count']
-            session.delete(
-                'credits/batches/{batch_id}/'.format(batch_id=last_batch['id'])
-            )
+
+            def count_credits(resolution):
+                return session.get(
+                    'credits/', params={'resolution': resolution, 'pk': credit_ids}
+                ).json()['count']
+
+            with ThreadPoolExecutor(max_workers=2, thread_name_prefix='credit-batch') as executor:
+                incomplete_credits = executor.submit(count_credits, 'pending')
+                credited_credits = executor.submit(count_credits, 'credited')
+                incomplete_credits = incomplete_credits.result()
+                if not last_batch['expired'] and incomplete_credits:
+                    # the credited count is not needed while the batch is still processing
+                    return redirect('processing-credits')
+                credited_credits = credited_credits.result()
+
+            # the batch is deleted off the response path so it may still be listed if the page is reloaded quickly
+            if request.session.get(self.reported_batch_session_key) != last_batch['id']:
+                request.session[self.reported_batch_session_key] = last_batch['id']
+                kwargs['credited_credits'] = credited_credits
+                kwargs['failed_credits'] = incomplete_credits
+            delete_credit_batch(user=request.user, user_session=request.session, batch_id=last_batch['id'])
 
         for message in messages.get_messages(request):
             if message.level == MANUALLY_CREDITED_LOG_LEVEL:
@@ -135,8 +169,18 @@ class NewCreditsView(CashbookView, FormView):
         context['start_page_url'] = settings.START_PAGE_URL
 
         new_credit_choices = context['form']['new'].credit_choices
-        context['new_object_list'] = new_credit_choices
-        context['total'] = sum([x[1]['amount'] for x in new_credit_choices])
+        context['snapshot_token'] = save_credit_snapshot(self.request.user, dict(new_credit_choices))
+        # identifies the credits in the snapshot rather than those a submitted form was validated against
+        context['credit_ids_digest'] = get_credit_ids_digest(credit_id for credit_id, _ in new_credit_choices)
+        # a submitted form is shown in full so that no selected credits are hidden
+        show_all = self.request.method == 'POST' or self.request.GET.get('show') == 'all'
+        context['new_object_list'], context['next_window_url'] = self.get_credits_window(
+            new_credit_choices, context['snapshot_token'], show_all=show_all,
+        )
+        context['all_credits_url'] = self.get_all_credits_url()
+        context['changes_token'] = PendingCreditChanges.make_token(credit for _, credit in new_credit_choices)
+        context['changes_interval'] = settings.NEW_CREDITS_CHANGES_INTERVAL
+        context['total'] = sum(credit.amount for _, credit in new_credit_choices)
         context['new_credits'] = len(new_credit_choices)
 
         manual_credit_choices = context['form']['manual'].credit_choices
@@ -146,21 +190,20 @@ class NewCreditsView(CashbookView, FormView):
         unowned_manual_credits = []
         other_owners = set()
         unowned_oldest_date = None
+        locations = get_prisoner_locations(
+            manual_credit.prisoner_number for _, manual_credit in manual_credit_choices
+        )
         for credit_id, manual_credit in manual_credit_choices:
-            try:
-                location = nomis.get_location(manual_credit['prisoner_number'])
-                manual_credit['new_location'] = location
-            except RequestException:
-                pass
-            if manual_credit['owner'] == self.request.user.pk:
+            manual_credit.new_location = locations.get(manual_credit.prisoner_number)
+            if manual_credit.owner == self.request.user.pk:
                 owned_manual_credits.append((credit_id, manual_credit))
             else:
                 unowned_manual_credits.append((credit_id, manual_credit))
-                other_owners.add(manual_credit['owner_name'])
+                other_owners.add(manual_credit.owner_name)
                 if unowned_oldest_date is None or (
-                        manual_credit['set_manual_at'] is not None and
-                        unowned_oldest_date > manual_credit['set_manual_at']):
-                    unowned_oldest_date = manual_credit['set_manual_at']
+                        manual_credit.set_manual_at is not None and
+                        unowned_oldest_date > manual_credit.set_manual_at):
+                    unowned_oldest_date = manual_credit.set_manual_at
 
         context['owned_manual_object_list'] = owned_manual_credits
         context['owned_manual_credits'] = len(owned_manual_credits)
@@ -184,6 +227,10 @@ class NewCreditsView(CashbookView, FormView):
 
         request_params = self.request.GET.dict()
         request_params.setdefault('ordering', '-received_at')
+        # only links to re-order the page reuse the credits already loaded
+        request_params.pop('credit_set', None)
+        if self.credit_set_token:
+            request_params['credit_set'] = self.credit_set_token
         context['request_params'] = request_params
 
         return context
@@ -195,28 +242,192 @@ class NewCreditsView(CashbookView, FormView):
     def form_invalid(self, form):
         return self.render_to_response(self.get_context_data())
 
+    @property
+    def ordering(self):
+        return self.request.GET.get('ordering') or '-received_at'
+
+    def get_credits_window(self, credit_choices, snapshot_token, offset=0, show_all=False):
+        """
+        Limits the new credits rendered at once to NEW_CREDITS_WINDOW_SIZE,
+        returning the window and the url of the next one if there are more credits;
+        further windows are served from the snapshot of credits rendered to the user
+        """
+        if show_all:
+            return credit_choices[offset:], None
+        end = offset + settings.NEW_CREDITS_WINDOW_SIZE
+        if end >= len(credit_choices):
+            return credit_choices[offset:end], None
+        params = urlencode({'ordering': self.ordering, 'snapshot': snapshot_token, 'offset': end})
+        return credit_choices[offset:end], f'{reverse("new-credits-window")}?{params}'
+
+    def get_all_credits_url(self):
+        params = urlencode({'ordering': self.ordering, 'show': 'all'})
+        return f'{reverse("new-credits")}?{params}'
+
+
+class NewCreditsWindowView(NewCreditsView):
+    """
+    Renders a further window of new credit rows to be appended to the table as the user scrolls
+    using the snapshot of credits rendered with the page rather than loading them all again
+    """
+    template_name = 'cashbook/includes/new-credit-rows.html'
+    http_method_names = ['get']
+
+    def get(self, request, *args, **kwargs):
+        try:
+            offset = max(int(request.GET['offset']), 0)
+        except (KeyError, ValueError):
+            offset = 0
+        snapshot_token = request.GET.get('snapshot')
+        snapshot = load_credit_snapshot(request.user, snapshot_token)
+        if snapshot is None:
+            # the page leaves the link to show all credits in place
+            raise Http404('Credit snapshot has expired')
+        form = self.get_form()['new']
+        object_list, next_window_url = self.get_credits_window(list(snapshot.items()), snapshot_token, offset=offset)
+        return self.render_to_response({
+            'object_list': object_list,
+            'credits_name': form['credits'].html_name,
+            'pre_approval_required': request.pre_approval_required,
+            'next_window_url': next_window_url,
+            'all_credits_url': self.get_all_credits_url(),
+            'credits_shown': offset + len(object_list),
+            'credits_total': len(snapshot),
+        })
+
+
+class NewCreditsChangesView(NewCreditsView):
+    """
+    Responds with new credits added or resolved since the watermark held by the page
+    so that they can be merged into the table without reloading every pending credit;
+    they are merged into a new snapshot of the page's credits which the page then submits
+    """
+    http_method_names = ['get']
+
+    def get(self, request, *args, **kwargs):
+        snapshot_token = request.GET.get('snapshot')
+        snapshot = load_credit_snapshot(request.user, snapshot_token)
+        if snapshot is None:
+            # the page stops checking for changes
+            raise Http404('Credit snapshot has expired')
+        try:
+            changes = PendingCreditChanges(api_client.get_api_session(request), request.GET['token'], snapshot)
+        except (KeyError, signing.BadSignature):
+            return HttpResponseBadRequest()
+
+        response = {
+            'token': changes.next_token,
+            'added': [credit.id for credit in changes.added_credits],
+            'resolved': changes.resolved_ids,
+        }
+        if changes.has_changes:
+            credits = changes.merged_credits(self.ordering)
+            form = self.get_form()['new']
+            response.update(
+                snapshot=save_credit_snapshot(request.user, credits),
+                rows=render_to_string('cashbook/includes/new-credit-rows.html', {
+                    'object_list': [(credit.id, credit) for credit in changes.added_credits],
+                    'credits_name': form['credits'].html_name,
+                    'pre_approval_required': request.pre_approval_required,
+                }, request=request),
+                count=len(credits),
+                credit_ids_digest=get_credit_ids_digest(credits),
+            )
+        else:
+            response['snapshot'] = renew_credit_snapshot(request.user, snapshot_token)
+        return JsonResponse(response)
+
+
+class ManualCreditsView(NewCreditsView):
+    """
+    Marks credits that needed manual input as credited without re-rendering the New credits page,
+    responding with replacement rows for them and updated counts
+    """
+    http_method_names = ['post']
+
+    def post(self, request, *args, **kwargs):
+        form = self.get_form()['manual']
+        if not form.is_valid():
+            return JsonResponse({
+                'errors': [str(error) for errors in form.errors.values() for error in errors],
+            }, status=400)
+
+        credit_ids = form.mark_credited()
+        remaining = api_client.get_api_session(request).get(
+            'credits/', params={'status': 'credit_pending', 'resolution': 'manual', 'limit': 1}
+        ).json()['count']
+        return JsonResponse({
+            'credited': credit_ids,
+            'rows': render_to_string('cashbook/includes/manual-credit-done.html', {
+                'object_list': [(credit_id, form.credit_index[credit_id]) for credit_id in credit_ids],
+                'pre_approval_required': request.pre_approval_required,
+            }, request=request),
+            'manual_credits': remaining,
+            'manually_credited': form.manually_credited,
+        })
+
 
 class ProcessingCreditsView(CashbookView, TemplateView):
     title = _('Digital cashbook')
     template_name = 'cashbook/processing_credits.html'
 
+    def get_active_batch_credit_ids(self, session):
+        batches = session.get('credits/batches/').json()
+        if batches['count'] == 0 or batches['results'][0]['expired']:
+            return None
+        return batches['results'][0]['credits']
+
+    def get_progress(self, session, credit_ids):
+        total = len(credit_ids)
+        progress = get_crediting_progress(self.request.user, credit_ids)
+        if progress:
+            return self.get_published_progress(progress)
+        incomplete_credits = session.get(
+            'credits/', params={'resolution': 'pending', 'pk': credit_ids}
+        ).json()
+        done_credit_count = total - incomplete_credits['count']
+        return {'total': total, 'published': False, 'percentage': int((done_credit_count / total) * 100)}
+
+    @classmethod
+    def get_published_progress(cls, progress):
+        # credits that could not be credited remain pending
+        done_credit_count = progress['done'] + progress['manual']
+        progress['published'] = True
+        progress['percentage'] = int((done_credit_count / progress['total']) * 100)
+        return progress
+
     def get(self, request, *args, **kwargs):
         context = self.get_context_data(**kwargs)
         session = api_client.get_api_session(self.request)
-        batches = session.get('credits/batches/').json()
-        if batches['count'] == 0 or batches['results'][0]['expired']:
+        credit_ids = self.get_active_batch_credit_ids(session)
+        if credit_ids is None:
             return redirect('new-credits')
-        else:
-            credit_ids = batches['results'][0]['credits']
-            total = len(credit_ids)
-            incomplete_credits = session.get(
-                'credits/', params={'resolution': 'pending', 'pk': credit_ids}
-            ).json()
-            done_credit_count = total - incomplete_credits['count']
-            context['percentage'] = int((done_credit_count / total) * 100)
+        progress = self.get_progress(session, credit_ids)
+        context['percentage'] = progress['percentage']
+        context['progress_url'] = reverse('processing-credits-progress')
         return self.render_to_response(context)
 
 
+class ProcessingCreditsProgressView(ProcessingCreditsView):
+    """
+    Responds with crediting progress so that the processing page can update in place;
+    while crediting tasks publish progress for the user's batch it is read from the cache alone
+    """
+    http_method_names = ['get']
+
+    def get(self, request, *args, **kwargs):
+        progress = get_crediting_progress(request.user)
+        if progress and sum(progress[count] for count in ('done', 'failed', 'manual')) < progress['total']:
+            if not is_crediting_batch_check_due(request.user):
+                return JsonResponse(self.get_published_progress(progress))
+
+        session = api_client.get_api_session(request)
+        credit_ids = self.get_active_batch_credit_ids(session)
+        if credit_ids is None:
+            return JsonResponse({'redirect': reverse('new-credits')})
+        return JsonResponse(self.get_progress(session, credit_ids))
+
+
 class ProcessedCreditsListView(CashbookView, FormView):
     title = _('Processed credits')
     form_class = FilterProcessedCreditsListForm
@@ -10,10 +10,8 @@ from django import forms
 from django.conf import settings
 from django.core.validators import RegexValidator
 from django.db import models
-from django.utils import timezone
 from django.utils.encoding import force_str
 from django.utils.dateformat import format as date_format
-from django.utils.dateparse import parse_date, parse_datetime
 from django.utils.functional import cached_property
 from django.utils.html import format_html, format_html_join
 from django.utils.translation import (
@@ -26,6 +24,8 @@ from mtp_common.bank_accounts import (
 from mtp_common.auth.exceptions import HttpNotFoundError, Forbidden
 from requests.exceptions import RequestException
 
+from mtp_cashbook.utils import LazyDateFields
+
 logger = logging.getLogger('mtp')
 
 
@@ -519,27 +519,9 @@ class BaseSearchForm(forms.Form):
 
     def parse_date_fields(self, object_list, date_fields):
         """
-        MTP API responds with string date/time fields, this filter converts them to python objects
+        MTP API responds with string date/time fields, these are converted to python objects when first accessed
         """
-        parsers = (parse_datetime, parse_date)
-
-        def convert(credit):
-            for field in date_fields:
-                value = credit.get(field)
-                if not value or not isinstance(value, str):
-                    continue
-                for parser in parsers:
-                    try:
-                        value = parser(value)
-                        if isinstance(value, datetime.datetime):
-                            value = timezone.localtime(value)
-                        credit[field] = value
-                        break
-                    except (ValueError, TypeError):
-                        pass
-            return credit
-
-        return list(map(convert, object_list)) if object_list else object_list
+        return [LazyDateFields(item, date_fields) for item in object_list] if object_list else object_list
 
     def get_object_list_endpoint_path(self):
         raise NotImplementedError
@@ -3,6 +3,8 @@ from mtp_common import nomis
 import requests
 from requests.exceptions import RequestException
 
+from mtp_cashbook.utils import get_prisoner_location
+
 
 def get_disbursement_viability(request, disbursement):
     viability = {}
@@ -21,7 +23,7 @@ def get_disbursement_viability(request, disbursement):
         pass
 
     try:
-        location = nomis.get_location(disbursement['prisoner_number'])
+        location = get_prisoner_location(disbursement['prisoner_number'])
 
         viability['prisoner_moved'] = (
             disbursement['prison'] != location['nomis_id']
@@ -8,14 +8,36 @@ export var BatchValidation = {
 
   init: function () {
     this.$form = $(this.selector);
-    this.$credits = $('[name="' + this.$form.data('credits-name') + '"]');
+    this.creditsSelector = '[name="' + this.$form.data('credits-name') + '"]';
+    this.$selectAllInput = $('.mtp-input--select-all-credits');
+    this.$excludedInput = $('.mtp-input--excluded-credits');
     this.$form.on('click', ':submit', $.proxy(this.onSubmit, this));
+    this.$form.on('submit', $.proxy(this.onFormSubmit, this));
+    // re-enable checkboxes if the page is restored from the browser's history
+    $(window).on('pageshow', $.proxy(this.enableCredits, this));
+  },
+
+  _allSelected: function () {
+    // all credits are selected, including those not loaded into the page yet
+    return Boolean(this.$selectAllInput.val());
+  },
+
+  _numExcluded: function () {
+    var excluded = this.$excludedInput.val();
+    return excluded ? excluded.split(',').length : 0;
   },
 
   _allChecked: function () {
     var allChecked = true;
 
-    this.$credits.each(function (i, el) {
+    if (this._allSelected()) {
+      return this._numExcluded() === 0;
+    }
+    if ($(this.selector).find('.mtp-new-credits__next-window').length) {
+      // some credits have not been loaded so cannot have been checked
+      return false;
+    }
+    $(this.creditsSelector).each(function (i, el) {
       var $item = $(el);
 
       if (!$item.is(':checked')) {
@@ -30,7 +52,10 @@ export var BatchValidation = {
   _numChecked: function () {
     var count = 0;
 
-    this.$credits.each(function (i, el) {
+    if (this._allSelected()) {
+      return parseInt(this.$form.data('credits-total'), 10) - this._numExcluded();
+    }
+    $(this.creditsSelector).each(function (i, el) {
       var $item = $(el);
 
       if ($item.is(':checked')) {
@@ -61,5 +86,16 @@ export var BatchValidation = {
       var pageLocation = '/batch/-dialog_open/';
       Analytics.ga4SendPageView(pageLocation);
     }
+  },
+
+  // when all credits are selected only exclusions are submitted so the size of the request does not grow with them
+  onFormSubmit: function () {
+    if (this._allSelected()) {
+      $(this.creditsSelector).prop('disabled', true);
+    }
+  },
+
+  enableCredits: function () {
+    $(this.creditsSelector).prop('disabled', false);
   }
 };
@@ -0,0 +1,182 @@
+// Merges new credits added or resolved since the page was loaded
+'use strict';
+
+export var CreditChanges = {
+  selector: '.mtp-form--batch-validation',
+  rowsSelector: '.mtp-new-credits__rows',
+  rowSelector: 'tr.mtp-new-credits__row',
+  // fields whose values sort as numbers rather than strings
+  numericFields: ['received_at', 'amount'],
+
+  init: function () {
+    this.$form = $(this.selector);
+    this.$rows = this.$form.find(this.rowsSelector);
+    this.interval = parseInt(this.$form.data('changes-interval'), 10) * 1000;
+    if (this.$rows.length === 0 || !this.interval) {
+      return;
+    }
+    var ordering = this.$form.data('ordering') || '-received_at';
+    this.orderingField = ordering.replace(/^-/, '');
+    this.orderingReversed = ordering.charAt(0) === '-';
+    this.$selectAllInput = $('.mtp-input--select-all-credits');
+    this.$snapshotInput = $('.mtp-input--credit-snapshot');
+    // credits resolved since the page was loaded, removed from windows that are loaded later
+    this.resolved = {};
+    // added credits ordered after every row loaded so far, shown once the window they belong in is loaded
+    this.held = [];
+    $('body').on('CreditWindow.loaded', $.proxy(this.onWindowLoaded, this));
+    this.schedule();
+  },
+
+  schedule: function () {
+    setTimeout($.proxy(this.check, this), this.interval);
+  },
+
+  check: function () {
+    if (document.hidden) {
+      this.schedule();
+      return;
+    }
+    $.ajax({
+      url: this.$form.data('changes-url'),
+      data: {token: this.$form.data('changes-token'), snapshot: this.$snapshotInput.val()},
+      dataType: 'json'
+    })
+      .done($.proxy(this.merge, this))
+      .always($.proxy(function (response, status) {
+        if (status === 'error' && response.status === 404) {
+          // the page's snapshot has expired so changes can no longer be merged into it
+          return;
+        }
+        this.schedule();
+      }, this));
+  },
+
+  sortValue: function ($row) {
+    var value = $row.attr('data-' + this.orderingField);
+    if (value === undefined || value === '') {
+      return null;
+    }
+    return $.inArray(this.orderingField, this.numericFields) === -1 ? value : parseFloat(value);
+  },
+
+  compare: function (a, b) {
+    // like the API, nulls sort as the largest values
+    var order;
+    if (a === b) {
+      order = 0;
+    } else if (a === null) {
+      order = 1;
+    } else if (b === null) {
+      order = -1;
+    } else {
+      order = a < b ? -1 : 1;
+    }
+    return this.orderingReversed ? -order : order;
+  },
+
+  place: function ($credit) {
+    var value = this.sortValue($credit.first());
+    var $before = null;
+
+    this.$rows.find(this.rowSelector).each($.proxy(function (i, row) {
+      var $row = $(row);
+      if (this.compare(value, this.sortValue($row)) < 0) {
+        $before = $row;
+        return false;
+      }
+    }, this));
+    if ($before) {
+      $before.before($credit);
+    } else if (this.$rows.find('.mtp-new-credits__next-window').length) {
+      this.held.push($credit);
+      return false;
+    } else {
+      this.$rows.append($credit);
+    }
+    return true;
+  },
+
+  placeAll: function (credits) {
+    var $placed = $();
+    $.each(credits, $.proxy(function (i, $credit) {
+      if (this.place($credit)) {
+        $placed = $placed.add($credit);
+      }
+    }, this));
+    return $placed;
+  },
+
+  onWindowLoaded: function (e, $rows) {
+    var resolved = this.resolved;
+    $rows.filter(function () {
+      return resolved[$(this).data('credit-id')];
+    }).remove();
+
+    if (this.held.length && !this.placing) {
+      var held = this.held;
+      this.held = [];
+      this.placing = true;
+      $('body').trigger('CreditWindow.loaded', [this.placeAll(held)]);
+      this.placing = false;
+    }
+  },
+
+  merge: function (changes) {
+    var $rows = this.$rows;
+    var resolved = this.resolved;
+
+    this.$form.data('changes-token', changes.token);
+    if (changes.snapshot) {
+      this.$snapshotInput.val(changes.snapshot);
+    }
+    if (!changes.rows && changes.count === undefined) {
+      return;
+    }
+
+    $.each(changes.resolved, function (i, creditId) {
+      resolved[creditId] = true;
+      $rows.find('tr[data-credit-id="' + creditId + '"]').remove();
+    });
+    this.held = $.grep(this.held, function ($credit) {
+      return !resolved[$credit.data('credit-id')];
+    });
+    var $added = $($.parseHTML(changes.rows.trim())).filter('tr');
+    var credits = $.map(changes.added, function (creditId) {
+      var $credit = $added.filter('[data-credit-id="' + creditId + '"]');
+      if ($credit.length === 0 || $rows.find('tr[data-credit-id="' + creditId + '"]').length) {
+        return null;
+      }
+      // wrapped so that $.map keeps each credit's rows together
+      return [$credit];
+    });
+
+    // the set of credits has changed so all of them need to be selected again
+    this.$selectAllInput.data('value', changes.credit_ids_digest).val('');
+    $('.mtp-input--excluded-credits').val('');
+    $('.mtp-checkboxes--select-all').prop({checked: false, indeterminate: false});
+
+    this.placing = true;
+    $('body').trigger('CreditWindow.loaded', [this.placeAll(credits)]);
+    this.placing = false;
+
+    this.$form.data('credits-total', changes.count);
+    this.displayCount(changes.count);
+    // refresh selection count
+    $('.mtp-input--counted').first().change();
+  },
+
+  displayCount: function (count) {
+    var $count = $('.mtp-new-credits__count');
+    if (typeof django === 'undefined') {
+      $count.find('strong').text(count);
+      return;
+    }
+    var message = django.ngettext(
+      '%(count)s new credit.',
+      '%(count)s new credits.',
+      count
+    );
+    $count.html(django.interpolate(message, {'count': '<strong>' + count + '</strong>'}, true));
+  }
+};
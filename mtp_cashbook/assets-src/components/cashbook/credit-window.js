@@ -0,0 +1,53 @@
+// Loads further windows of new credits as the user scrolls
+'use strict';
+
+export var CreditWindow = {
+  selector: '.mtp-new-credits__next-window',
+  // how far below the visible part of the page to start loading the next window
+  threshold: 600,
+
+  init: function () {
+    if ($(this.selector).length === 0) {
+      return;
+    }
+    this.$window = $(window);
+    this.loading = false;
+    this.$window.on('scroll.CreditWindow resize.CreditWindow', $.proxy(this.onScroll, this));
+    this.onScroll();
+  },
+
+  onScroll: function () {
+    var $nextWindow = $(this.selector);
+    if (this.loading) {
+      return;
+    }
+    if ($nextWindow.length === 0) {
+      this.$window.off('.CreditWindow');
+      return;
+    }
+    if ($nextWindow.offset().top < this.$window.scrollTop() + this.$window.height() + this.threshold) {
+      this.load($nextWindow);
+    }
+  },
+
+  load: function ($nextWindow) {
+    this.loading = true;
+    $.ajax({
+      url: $nextWindow.data('url'),
+      dataType: 'html'
+    }).done($.proxy(function (rows) {
+      var $rows = $($.parseHTML(rows.trim())).filter('tr').filter(function () {
+        // credits may have moved between windows since the page was loaded
+        var creditId = $(this).data('credit-id');
+        return !creditId || $('tr[data-credit-id="' + creditId + '"]').length === 0;
+      });
+      $nextWindow.replaceWith($rows);
+      $('body').trigger('CreditWindow.loaded', [$rows]);
+      this.loading = false;
+      this.onScroll();
+    }, this)).fail($.proxy(function () {
+      // leave the link to show all credits in place
+      this.$window.off('.CreditWindow');
+    }, this));
+  }
+};
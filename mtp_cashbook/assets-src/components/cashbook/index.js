@@ -1,6 +1,10 @@
 'use strict';
 
 import {BatchValidation} from './batch-validation';
+import {CreditChanges} from './credit-changes';
+import {CreditWindow} from './credit-window';
+import {ManualCredits} from './manual-credits';
+import {ProcessingProgress} from './processing-progress';
 import {SelectAll} from './select-all';
 import {StickyHeader} from './sticky-header';
 
@@ -9,6 +13,10 @@ export var Cashbook = {
     SelectAll.init();
     StickyHeader.init();
     BatchValidation.init();
+    CreditWindow.init();
+    CreditChanges.init();
+    ManualCredits.init();
+    ProcessingProgress.init();
     this.initSelectionCount();
     this.initConfirmManual();
   },
@@ -17,8 +25,14 @@ export var Cashbook = {
     // displays a running count of selected credits
     $('.mtp-input--selection-count').each(function () {
       var $countContainer = $(this);
-      $('.mtp-input--counted').on('change', function () {
+      $('body').on('change', '.mtp-input--counted', function () {
         var itemCount = $('.mtp-input--counted:checked').length;
+        if ($('.mtp-input--select-all-credits').val()) {
+          // all credits are selected, including those not loaded into the page yet, apart from exclusions
+          var excluded = $('.mtp-input--excluded-credits').val();
+          itemCount = parseInt($('.mtp-form--batch-validation').data('credits-total'), 10);
+          itemCount -= excluded ? excluded.split(',').length : 0;
+        }
         displayCreditSelectionCount(itemCount, $countContainer);
       });
     });
@@ -0,0 +1,77 @@
+// Marks manual credits as credited without reloading the page
+'use strict';
+
+export var ManualCredits = {
+  selector: '.mtp-form--confirm-manual',
+
+  init: function () {
+    this.$form = $(this.selector);
+    this.url = this.$form.data('manual-credits-url');
+    if (this.$form.length === 0 || !this.url) {
+      return;
+    }
+    this.$status = this.$form.find('.mtp-manual-credits__status');
+    // only confirmations from dialogue boxes are sent, see Cashbook.initConfirmManual
+    this.$form.on('click', ':submit[value="override"]', $.proxy(this.onConfirm, this));
+  },
+
+  onConfirm: function (e) {
+    var $button = $(e.target).closest(':submit');
+    var data = this.$form.serializeArray();
+
+    e.preventDefault();
+    data.push({name: $button.attr('name'), value: $button.val()});
+    $button.prop('disabled', true);
+    $.ajax({
+      // the query string carries the running count of manually credited credits
+      url: this.url + (this.$form.attr('action') || ''),
+      method: 'POST',
+      data: $.param(data),
+      dataType: 'json'
+    }).done($.proxy(function (response) {
+      $button.closest('.mtp-dialogue').trigger('dialogue:close');
+      this.update(response);
+    }, this)).fail($.proxy(function () {
+      // fall back to submitting the whole page
+      $button.closest('.mtp-dialogue').trigger('dialogue:close');
+      $('<input type="hidden">').attr({name: $button.attr('name'), value: $button.val()}).appendTo(this.$form);
+      this.$form[0].submit();
+    }, this));
+  },
+
+  update: function (response) {
+    var $form = this.$form;
+    var $rows = $($.parseHTML(response.rows.trim())).filter('tbody');
+
+    $rows.each(function () {
+      var creditId = $(this).data('credit-id');
+      $form.find('.mtp-manual-credit[data-credit-id="' + creditId + '"]').replaceWith(this);
+    });
+    $form.attr('action', '?manually_credited=' + response.manually_credited);
+    displayManualCreditsStatus(response.manually_credited, response.manual_credits, this.$status);
+  }
+};
+
+function displayManualCreditsStatus (manuallyCredited, manualCredits, $status) {
+  if (typeof django === 'undefined') {
+    // if django js library hasn't loaded yet, fall back to simple message
+    $status.text(
+      'Credits manually input by you into NOMIS: ' + manuallyCredited + '. ' +
+      'Credits still needing manual input: ' + manualCredits + '.'
+    );
+    return;
+  }
+
+  $status.text(
+    django.interpolate(django.ngettext(
+      '%(count)s credit manually input by you into NOMIS.',
+      '%(count)s credits manually input by you into NOMIS.',
+      manuallyCredited
+    ), {'count': manuallyCredited}, true) + ' ' +
+    django.interpolate(django.ngettext(
+      '%(count)s credit still needs manual input.',
+      '%(count)s credits still need manual input.',
+      manualCredits
+    ), {'count': manualCredits}, true)
+  );
+}
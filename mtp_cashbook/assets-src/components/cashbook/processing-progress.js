@@ -0,0 +1,60 @@
+// Updates crediting progress in place as crediting tasks publish it
+'use strict';
+
+export var ProcessingProgress = {
+  selector: '.mtp-progress-bar[data-progress-url]',
+  // delay before checking again, growing while progress is unchanged
+  minInterval: 5000,
+  maxInterval: 15000,
+  backoff: 1.5,
+
+  init: function () {
+    this.$progressBar = $(this.selector);
+    if (this.$progressBar.length === 0) {
+      return;
+    }
+    this.$fill = this.$progressBar.find('.mtp-progress-bar__fill');
+    this.$percentage = this.$progressBar.find('.mtp-progress-bar__percentage');
+    this.percentage = parseInt(this.$progressBar.data('percentage'), 10);
+    this.interval = this.minInterval;
+    this.schedule();
+  },
+
+  schedule: function () {
+    setTimeout($.proxy(this.check, this), this.interval);
+  },
+
+  check: function () {
+    $.ajax({
+      url: this.$progressBar.data('progress-url'),
+      dataType: 'json'
+    }).done($.proxy(this.update, this)).fail($.proxy(function () {
+      this.interval = this.maxInterval;
+      this.schedule();
+    }, this));
+  },
+
+  update: function (progress) {
+    if (progress.redirect) {
+      window.location.href = progress.redirect;
+      return;
+    }
+    if (progress.percentage >= 100) {
+      // show finished page
+      window.location.reload();
+      return;
+    }
+    if (!progress.published) {
+      // progress not published by crediting tasks is loaded from the api so is checked less often
+      this.interval = this.maxInterval;
+    } else if (progress.percentage !== this.percentage) {
+      this.interval = this.minInterval;
+    } else {
+      this.interval = Math.min(this.interval * this.backoff, this.maxInterval);
+    }
+    this.percentage = progress.percentage;
+    this.$fill.css('width', progress.percentage + '%');
+    this.$percentage.text(progress.percentage + '%');
+    this.schedule();
+  }
+};
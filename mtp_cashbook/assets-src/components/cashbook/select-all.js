@@ -10,9 +10,13 @@ export var SelectAll = {
       return;
     }
     this.checksSelector = '[name="' + this.$selectAll.data('name') + '"]';
-    this.$checks = $(this.checksSelector);
+    // holds a value while all credits are selected, including those not loaded into the page yet,
+    // in which case unchecked credits are listed as exclusions rather than checked ones being submitted
+    this.$selectAllInput = $('.mtp-input--select-all-credits');
+    this.$excludedInput = $('.mtp-input--excluded-credits');
     $('body')
       .on('SelectAll.render', $.proxy(this.render, this))
+      .on('CreditWindow.loaded', $.proxy(this.onWindowLoaded, this))
       .on('change.SelectAll', this.selector, $.proxy(this.onSelectAllChange, this))
       .on('change.SelectAll', this.checksSelector, $.proxy(this.onCheckChange, this))
       .on('keypress.SelectAll', this.checksSelector + ', ' + this.selector, $.proxy(this.onCheckKeypress, this));
@@ -22,7 +26,9 @@ export var SelectAll = {
   onSelectAllChange: function (e) {
     var clickedEl = e.target;
 
-    this.$checks.each(function () {
+    this.$selectAllInput.val(clickedEl.checked ? this.$selectAllInput.data('value') : '');
+    this.$excludedInput.val('');
+    $(this.checksSelector).each(function () {
       this.checked = clickedEl.checked;
       $(this).change();
     });
@@ -31,6 +37,7 @@ export var SelectAll = {
     // but don't trigger a change to avoid loop
     this.$selectAll.each(function () {
       this.checked = clickedEl.checked;
+      this.indeterminate = false;
     });
   },
 
@@ -43,6 +50,38 @@ export var SelectAll = {
     } else {
       $row.removeClass('mtp-table__highlighted-row');
     }
+    if (this.$selectAllInput.val()) {
+      this.updateExcluded($checkEl.val(), !$checkEl.is(':checked'));
+    }
+  },
+
+  getExcluded: function () {
+    var excluded = this.$excludedInput.val();
+    return excluded ? excluded.split(',') : [];
+  },
+
+  updateExcluded: function (creditId, exclude) {
+    var excluded = $.grep(this.getExcluded(), function (excludedId) {
+      return excludedId !== creditId;
+    });
+    if (exclude) {
+      excluded.push(creditId);
+    }
+    this.$excludedInput.val(excluded.join(','));
+    this.$selectAll.each(function () {
+      this.indeterminate = excluded.length > 0;
+    });
+  },
+
+  onWindowLoaded: function (e, $rows) {
+    var allSelected = Boolean(this.$selectAllInput.val());
+
+    $rows.find(this.checksSelector).each(function () {
+      if (allSelected) {
+        this.checked = true;
+      }
+      $(this).change();
+    });
   },
 
   onCheckKeypress: function (e) {
@@ -54,7 +93,7 @@ export var SelectAll = {
   },
 
   render: function () {
-    this.$checks.each(function () {
+    $(this.checksSelector).each(function () {
       $(this).change();
     });
   }
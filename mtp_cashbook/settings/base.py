@@ -126,11 +126,70 @@ CSRF_FAILURE_VIEW = 'mtp_common.auth.csrf.csrf_failure'
 
 # Data stores
 DATABASES = {}
+# file-based caches are shared between uWSGI workers and spooler processes
+SHARED_CACHE_DIR = os.environ.get('SHARED_CACHE_DIR') or join(dirname(BASE_DIR), 'cache')
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         'LOCATION': 'mtp',
-    }
+    },
+    'prisoner_locations': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': join(SHARED_CACHE_DIR, 'prisoner-locations'),
+        'TIMEOUT': int(os.environ.get('PRISONER_LOCATION_CACHE_TIMEOUT', str(60 * 10))),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('PRISONER_LOCATION_CACHE_MAX_ENTRIES', '5000')),
+        },
+    },
+    # new credits rendered to users, kept so that submitting the page does not load all pending credits again
+    'credit_snapshots': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': join(SHARED_CACHE_DIR, 'credit-snapshots'),
+        'TIMEOUT': int(os.environ.get('CREDIT_SNAPSHOT_CACHE_TIMEOUT', str(60 * 30))),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('CREDIT_SNAPSHOT_CACHE_MAX_ENTRIES', '500')),
+        },
+    },
+    # references of confirmation emails sent to senders of credited credits
+    'credited_confirmations': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': join(SHARED_CACHE_DIR, 'credited-confirmations'),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('CREDITED_CONFIRMATION_CACHE_MAX_ENTRIES', '50000')),
+        },
+    },
+    # prisoners whose balances were recently checked against the cap
+    'prisoner_cap_checks': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': join(SHARED_CACHE_DIR, 'prisoner-cap-checks'),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('PRISONER_CAP_CHECK_CACHE_MAX_ENTRIES', '5000')),
+        },
+    },
+    # state of the NOMIS circuit breaker shared by crediting tasks
+    'nomis_circuit': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': join(SHARED_CACHE_DIR, 'nomis-circuit'),
+        'TIMEOUT': None,
+    },
+    # progress of crediting batches published by crediting tasks
+    'crediting_progress': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': join(SHARED_CACHE_DIR, 'crediting-progress'),
+        'TIMEOUT': int(os.environ.get('CREDITING_PROGRESS_CACHE_TIMEOUT', str(60 * 60))),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('CREDITING_PROGRESS_CACHE_MAX_ENTRIES', '5000')),
+        },
+    },
+    # credits loaded for users, kept briefly so that changing only their ordering does not load them all again
+    'credit_sets': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': join(SHARED_CACHE_DIR, 'credit-sets'),
+        'TIMEOUT': int(os.environ.get('CREDIT_SET_CACHE_TIMEOUT', '120')),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('CREDIT_SET_CACHE_MAX_ENTRIES', '500')),
+        },
+    },
 }
 
 
@@ -271,6 +330,44 @@ LOGOUT_URL = 'logout'
 OAUTHLIB_INSECURE_TRANSPORT = True
 
 REQUEST_PAGE_SIZE = 100
+# maximum number of pages requested from the API at once when loading all pages of a list
+API_CONCURRENT_PAGE_REQUESTS = int(os.environ.get('API_CONCURRENT_PAGE_REQUESTS', '4'))
+# maximum number of prisons whose lists are loaded at once for users with access to several prisons
+API_CONCURRENT_PRISON_REQUESTS = int(os.environ.get('API_CONCURRENT_PRISON_REQUESTS', '4'))
+
+# number of new credits rendered at once, further windows are loaded as the user scrolls
+NEW_CREDITS_WINDOW_SIZE = int(os.environ.get('NEW_CREDITS_WINDOW_SIZE', '200'))
+# seconds between checks for new credits added or resolved while the New credits page is open
+NEW_CREDITS_CHANGES_INTERVAL = int(os.environ.get('NEW_CREDITS_CHANGES_INTERVAL', '60'))
+
+# concurrent NOMIS location lookups when showing credits needing manual input
+NOMIS_LOCATION_LOOKUP_WORKERS = int(os.environ.get('NOMIS_LOCATION_LOOKUP_WORKERS', '10'))
+NOMIS_LOCATION_LOOKUP_TIMEOUT = float(os.environ.get('NOMIS_LOCATION_LOOKUP_TIMEOUT', '10'))
+
+# selected credits are sent to NOMIS in spooled chunks of this size so that large batches spread across spoolers
+CREDITING_BATCH_CHUNK_SIZE = int(os.environ.get('CREDITING_BATCH_CHUNK_SIZE', '100'))
+# while crediting tasks publish progress, the API is asked whether the batch has expired at most this often in seconds
+CREDITING_BATCH_CHECK_INTERVAL = int(os.environ.get('CREDITING_BATCH_CHECK_INTERVAL', '60'))
+# credits in a chunk are sent to NOMIS concurrently, overall and to any one prison
+NOMIS_CREDITING_WORKERS = int(os.environ.get('NOMIS_CREDITING_WORKERS', '8'))
+NOMIS_CREDITING_WORKERS_PER_PRISON = int(os.environ.get('NOMIS_CREDITING_WORKERS_PER_PRISON', '4'))
+# outcomes of crediting are written to the API in bulk once this many accumulate or this many seconds pass
+CREDIT_UPDATES_BATCH_SIZE = int(os.environ.get('CREDIT_UPDATES_BATCH_SIZE', '50'))
+CREDIT_UPDATES_INTERVAL = float(os.environ.get('CREDIT_UPDATES_INTERVAL', '5'))
+# crediting tasks checkpoint credits sent to NOMIS here so that interrupted tasks resume where they stopped
+CREDITING_CHECKPOINT_DIR = (
+    os.environ.get('CREDITING_CHECKPOINT_DIR') or join(dirname(BASE_DIR), 'spooler', 'checkpoints')
+)
+# checkpoints kept because some outcomes could not be written to the API are removed after this many seconds
+CREDITING_CHECKPOINT_MAX_AGE = int(os.environ.get('CREDITING_CHECKPOINT_MAX_AGE', str(60 * 60 * 24 * 7)))
+# crediting stops calling NOMIS after this many consecutive server or connection errors
+NOMIS_CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('NOMIS_CIRCUIT_BREAKER_FAILURE_THRESHOLD', '5'))
+# and then lets one trial call through this many seconds later to check whether NOMIS has recovered
+NOMIS_CIRCUIT_BREAKER_RESET_TIMEOUT = int(os.environ.get('NOMIS_CIRCUIT_BREAKER_RESET_TIMEOUT', '30'))
+# confirmation emails to senders are not sent again for the same credit within this many seconds
+CREDITED_CONFIRMATION_DEDUPLICATION_PERIOD = int(
+    os.environ.get('CREDITED_CONFIRMATION_DEDUPLICATION_PERIOD', str(60 * 60 * 24))
+)
 
 ANALYTICS_REQUIRED = os.environ.get('ANALYTICS_REQUIRED', 'True') == 'True'
 GA4_MEASUREMENT_ID = os.environ.get('GA4_MEASUREMENT_ID', None)
@@ -311,6 +408,8 @@ POSTCODE_LOOKUP_AUTH_TOKEN = os.environ.get('POSTCODE_LOOKUP_AUTH_TOKEN', '')
 
 PRISONER_CAPPING_ENABLED = bool(int(os.environ.get('PRISONER_CAPPING_ENABLED', '0')))
 PRISONER_CAPPING_THRESHOLD_IN_POUNDS = int(os.environ.get('PRISONER_CAPPING_THRESHOLD_IN_POUNDS', '900'))
+# balances of prisoners credited again within this many seconds are not re-checked
+PRISONER_CAPPING_CHECK_PERIOD = int(os.environ.get('PRISONER_CAPPING_CHECK_PERIOD', str(60 * 10)))
 
 # Feature toggle for copy changes relating to bank transfers
 BANK_TRANSFERS_ENABLED = bool(
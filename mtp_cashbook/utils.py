@@ -1,7 +1,24 @@
 import datetime
+import functools
+import os
 
+from django.apps import apps
+from django.core.cache import caches
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from mtp_common import nomis
 from mtp_common.auth import USER_DATA_SESSION_KEY
 from mtp_common.auth.api_client import get_api_session
+from prometheus_client import Counter
+
+prisoner_location_cache_lookups = Counter(
+    'mtp_cashbook_prisoner_location_cache_lookups', 'Shared prisoner location cache lookups',
+    labelnames=('result', 'pid'),
+)
+try:
+    apps.get_app_config('metrics').register_collector(prisoner_location_cache_lookups)
+except LookupError:
+    pass
 
 
 def add_user_flag(request, flag):
@@ -54,3 +71,107 @@ def merge_credit_notice_emails_with_user_prisons(credit_notice_emails, request):
 
 def one_month_ago():
     return datetime.date.today() - datetime.timedelta(days=30)
+
+
+def _prisoner_location_cache_key(prisoner_number):
+    return f'prisoner-location-{prisoner_number}'
+
+
+def get_prisoner_location(prisoner_number):
+    """
+    Gets a prisoner's NOMIS location through a cache shared by all uWSGI workers,
+    the TTL and size cap of which are set by the `prisoner_locations` cache configuration.
+    Failed lookups are not cached.
+    """
+    cache = caches['prisoner_locations']
+    cache_key = _prisoner_location_cache_key(prisoner_number)
+    location = cache.get(cache_key)
+    if location is not None:
+        prisoner_location_cache_lookups.labels(result='hit', pid=str(os.getpid())).inc()
+        return location
+
+    prisoner_location_cache_lookups.labels(result='miss', pid=str(os.getpid())).inc()
+    location = nomis.get_location(prisoner_number)
+    if location is not None:
+        cache.set(cache_key, location)
+    return location
+
+
+def invalidate_prisoner_location(prisoner_number):
+    caches['prisoner_locations'].delete(_prisoner_location_cache_key(prisoner_number))
+
+
+def parse_date_value(value):
+    """
+    Converts an MTP API date/time string into a python object in the current time zone;
+    values that are not strings or cannot be parsed are returned unchanged
+    """
+    if not value or not isinstance(value, str):
+        return value
+    return _parse_date_value(value, timezone.get_current_timezone_name())
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_date_value(value, timezone_name):
+    # many objects in one response share timestamps so parsed values are memoised;
+    # the time zone name is only part of the key so that activating another one is respected
+    try:
+        parsed_value = parse_datetime(value)
+    except ValueError:
+        parsed_value = None
+    if parsed_value is not None and timezone.is_aware(parsed_value):
+        return timezone.localtime(parsed_value)
+    # plain dates are otherwise parsed as naive datetimes
+    try:
+        parsed_value = parse_date(value)
+    except ValueError:
+        parsed_value = None
+    return value if parsed_value is None else parsed_value
+
+
+class LazyDateFields(dict):
+    """
+    MTP API response object whose string date/time fields are converted
+    into python objects when first accessed rather than up-front
+    """
+
+    def __init__(self, data, date_fields):
+        super().__init__(data)
+        self.date_fields = frozenset(date_fields)
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if key in self.date_fields and isinstance(value, str):
+            parsed_value = parse_date_value(value)
+            if parsed_value is not value:
+                self[key] = parsed_value
+            return parsed_value
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class LazyDateField:
+    """
+    Descriptor for a date/time attribute of a slotted record which is stored as received from
+    the MTP API in a slot named with a leading underscore and converted when first accessed
+    """
+
+    def __set_name__(self, owner, name):
+        self.slot = f'_{name}'
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        value = getattr(instance, self.slot)
+        if isinstance(value, str):
+            value = parse_date_value(value)
+            setattr(instance, self.slot, value)
+        return value
+
+    def __set__(self, instance, value):
+        setattr(instance, self.slot, value)